@@ -0,0 +1,230 @@
+import argparse
+import json
+import math
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from latency_histogram import LatencyHistogram
+
+# Local SQLite store of profiling.py runs: config, git revision, latency histograms and throughput samples. Named
+# baselines point at a run, and `compare` checks a run against one, exiting non-zero on a p99 or throughput
+# regression so it can gate a deploy.
+
+BOOTSTRAP_SAMPLES = 2000
+
+
+def git_revision() -> str:
+    # Of the checkout these scripts are in, wherever they are run from
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        revision = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                                  cwd=repo).stdout
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, check=True, cwd=repo).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return revision.strip() + ("-dirty" if dirty.strip() else "")
+
+
+class BenchmarkStore:
+    def __init__(self, path: str = "benchmarks.sqlite"):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY, created REAL, git_revision TEXT, mode TEXT, config TEXT,
+                sent INTEGER, errors INTEGER, elapsed REAL, bytes INTEGER,
+                histogram TEXT, ttfb TEXT, tags TEXT, throughput_samples TEXT
+            );
+            CREATE TABLE IF NOT EXISTS baselines (name TEXT PRIMARY KEY, run_id INTEGER);
+        """)
+
+    def save(self, mode: str, config: dict, result) -> int:
+        # `result` is a profiling.LoadResult
+        cursor = self.db.execute(
+            "INSERT INTO runs (created, git_revision, mode, config, sent, errors, elapsed, bytes, histogram, ttfb, "
+            "tags, throughput_samples) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (time.time(), git_revision(), mode, json.dumps(config, default=str), result.sent,
+             sum(result.errors.values()), result.elapsed, result.bytes, json.dumps(result.histogram.to_dict()),
+             json.dumps(result.ttfb.to_dict()),
+             json.dumps({tag: histogram.to_dict() for tag, histogram in result.tags.items()}),
+             json.dumps(result.throughput_samples)),
+        )
+        self.db.commit()
+        return cursor.lastrowid
+
+    def run(self, run_id: int) -> dict:
+        row = self.db.execute("SELECT id, created, git_revision, mode, config, sent, errors, elapsed, bytes, "
+                              "histogram, ttfb, tags, throughput_samples FROM runs WHERE id = ?", (run_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"No run {run_id} in {self.path}")
+        run = dict(zip(["id", "created", "git_revision", "mode", "config", "sent", "errors", "elapsed", "bytes",
+                        "histogram", "ttfb", "tags", "throughput_samples"], row))
+        run["config"] = json.loads(run["config"])
+        run["histogram"] = LatencyHistogram.from_dict(json.loads(run["histogram"]))
+        run["ttfb"] = LatencyHistogram.from_dict(json.loads(run["ttfb"]))
+        run["tags"] = {tag: LatencyHistogram.from_dict(data) for tag, data in json.loads(run["tags"]).items()}
+        run["throughput_samples"] = json.loads(run["throughput_samples"])
+        return run
+
+    def latest(self) -> int:
+        row = self.db.execute("SELECT max(id) FROM runs").fetchone()
+        if row[0] is None:
+            raise KeyError(f"No runs in {self.path}")
+        return row[0]
+
+    def set_baseline(self, name: str, run_id: int):
+        self.run(run_id)
+        self.db.execute("INSERT OR REPLACE INTO baselines VALUES (?, ?)", (name, run_id))
+        self.db.commit()
+
+    def baseline(self, name: str) -> int:
+        row = self.db.execute("SELECT run_id FROM baselines WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(f"No baseline named {name!r} in {self.path}")
+        return row[0]
+
+    def runs(self, limit: int = 20) -> list:
+        return self.db.execute(
+            "SELECT runs.id, created, git_revision, mode, sent, errors, elapsed, group_concat(baselines.name) "
+            "FROM runs LEFT JOIN baselines ON baselines.run_id = runs.id GROUP BY runs.id ORDER BY runs.id DESC "
+            "LIMIT ?", (limit,)).fetchall()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def bootstrap_percentile(histogram: LatencyHistogram, percent: float, confidence: float = 0.95,
+                         seed: int = 0) -> tuple:
+    # Resamples the run's requests from its histogram buckets and takes the percentile of each resample
+    if histogram.count == 0:
+        return math.nan, math.nan
+    values, counts = zip(*histogram.values())
+    values = np.array(values)
+    rng = np.random.default_rng(seed)
+    resamples = rng.multinomial(histogram.count, np.array(counts) / histogram.count, size=BOOTSTRAP_SAMPLES)
+    rank = math.ceil(percent / 100 * histogram.count)
+    estimates = values[np.argmax(np.cumsum(resamples, axis=1) >= rank, axis=1)]
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(estimates, [tail, 100 - tail])
+    return float(low), float(high)
+
+
+def bootstrap_mean(samples: list, confidence: float = 0.95, seed: int = 0) -> tuple:
+    if len(samples) < 2:
+        return math.nan, math.nan
+    rng = np.random.default_rng(seed)
+    means = rng.choice(np.array(samples), size=(BOOTSTRAP_SAMPLES, len(samples))).mean(axis=1)
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(means, [tail, 100 - tail])
+    return float(low), float(high)
+
+
+def run_stats(run: dict) -> dict:
+    histogram = run["histogram"]
+    # Throughput is successful responses per second; its interval comes from the per-window rates of the run
+    samples = run["throughput_samples"]
+    return {
+        "p50": histogram.percentile(50),
+        "p90": histogram.percentile(90),
+        "p99": histogram.percentile(99),
+        "p99_ci": bootstrap_percentile(histogram, 99),
+        "p99.9": histogram.percentile(99.9),
+        "error_rate": run["errors"] / max(run["sent"], 1),
+        "throughput": (histogram.count - run["errors"]) / max(run["elapsed"], 1e-9),
+        "throughput_ci": bootstrap_mean(samples),
+    }
+
+
+def compare(store: BenchmarkStore, baseline_name: str, run_id: int | None, max_p99_increase: float,
+            max_throughput_decrease: float) -> bool:
+    # A regression must exceed the threshold and have a confidence interval clear of the baseline's, so noise
+    # between two equal runs doesn't fail the gate. Returns True when the run regressed.
+    base = store.run(store.baseline(baseline_name))
+    candidate = store.run(run_id if run_id is not None else store.latest())
+    base_stats = run_stats(base)
+    candidate_stats = run_stats(candidate)
+    print(f"Baseline {baseline_name!r}: run {base['id']} at {base['git_revision'][:12]}, "
+          f"{base['histogram'].count} responses")
+    print(f"Candidate: run {candidate['id']} at {candidate['git_revision'][:12]}, "
+          f"{candidate['histogram'].count} responses")
+    if base["config"] != candidate["config"]:
+        changed = sorted(key for key in base["config"].keys() | candidate["config"].keys()
+                         if base["config"].get(key) != candidate["config"].get(key))
+        print(f"Warning: the runs were configured differently ({', '.join(changed)})")
+
+    print(f"{'':<14} {'baseline':>24} {'candidate':>24} {'change':>9}")
+    for name in ("p50", "p90", "p99", "p99.9"):
+        print(f"{name + ' (ms)':<14} {format_stat(base_stats, name, 1000):>24} "
+              f"{format_stat(candidate_stats, name, 1000):>24} {change(base_stats[name], candidate_stats[name]):>9}")
+    print(f"{'throughput/s':<14} {format_stat(base_stats, 'throughput'):>24} "
+          f"{format_stat(candidate_stats, 'throughput'):>24} "
+          f"{change(base_stats['throughput'], candidate_stats['throughput']):>9}")
+    print(f"{'errors':<14} {100 * base_stats['error_rate']:>23.2f}% {100 * candidate_stats['error_rate']:>23.2f}%")
+
+    regressions = []
+    if (candidate_stats["p99"] > base_stats["p99"] * (1 + max_p99_increase)
+            and not candidate_stats["p99_ci"][0] <= base_stats["p99_ci"][1]):
+        regressions.append(f"p99 rose more than {100 * max_p99_increase:.0f}%")
+    if (candidate_stats["throughput"] < base_stats["throughput"] * (1 - max_throughput_decrease)
+            and not candidate_stats["throughput_ci"][1] >= base_stats["throughput_ci"][0]):
+        regressions.append(f"throughput fell more than {100 * max_throughput_decrease:.0f}%")
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    if not regressions:
+        print("No regression")
+    return bool(regressions)
+
+
+def format_stat(stats: dict, name: str, scale: float = 1.0) -> str:
+    value = f"{stats[name] * scale:.1f}"
+    low, high = stats.get(f"{name}_ci", (math.nan, math.nan))
+    if math.isnan(low):
+        return value
+    return f"{value} [{low * scale:.1f}, {high * scale:.1f}]"
+
+
+def change(before: float, after: float) -> str:
+    return f"{100 * (after - before) / before:+.1f}%" if before else ""
+
+
+def add_compare_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--max-p99-increase", type=float, default=0.10, help="Allowed relative p99 increase")
+    parser.add_argument("--max-throughput-decrease", type=float, default=0.05,
+                        help="Allowed relative throughput decrease")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Saved profiling.py runs and baseline comparisons")
+    parser.add_argument("--results", default="benchmarks.sqlite")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="Recent runs")
+    baseline = subparsers.add_parser("baseline", help="Name a run as a baseline")
+    baseline.add_argument("name")
+    baseline.add_argument("--run", type=int, help="Run id, the latest run by default")
+    compare_parser = subparsers.add_parser("compare", help="Compare a run with a baseline, exiting 1 on regression")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("--run", type=int, help="Run id, the latest run by default")
+    add_compare_arguments(compare_parser)
+    args = parser.parse_args()
+
+    store = BenchmarkStore(args.results)
+    if args.command == "list":
+        for run_id, created, revision, mode, sent, errors, elapsed, names in store.runs():
+            print(f"{run_id:>5} {time.strftime('%Y-%m-%d %H:%M', time.localtime(created))} {revision[:12]:<12} "
+                  f"{mode:<7} {sent:>8} sent {errors:>6} errors {elapsed:>7.1f}s {names or ''}")
+    elif args.command == "baseline":
+        run_id = args.run if args.run is not None else store.latest()
+        store.set_baseline(args.name, run_id)
+        print(f"Baseline {args.name!r} is run {run_id}")
+    else:
+        regressed = compare(store, args.baseline, args.run, args.max_p99_increase, args.max_throughput_decrease)
+        store.close()
+        sys.exit(1 if regressed else 0)
+    store.close()
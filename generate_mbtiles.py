@@ -0,0 +1,180 @@
+import argparse
+import gzip
+import json
+import math
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import mapbox_vector_tile
+import numpy as np
+import shapely
+import shapely.geometry
+
+from tile_store import TileStore, print_stats
+
+# Offline replacement for warming the cache through t-rex: reads the same `all_cities` table that
+# t-rex-config.toml points at and writes a gzip-compressed MBTiles archive, deduplicated through TileStore.
+
+EARTH_RADIUS = 6378137.0
+ORIGIN_SHIFT = math.pi * EARTH_RADIUS
+EXTENT = 4096
+LAYER_NAME = "all_cities"
+
+# Per-worker state, populated by `init_worker` so geometries aren't pickled for every task
+_geometries = None
+_ids = None
+_tree = None
+
+
+def lon_lat_to_mercator(coords: np.ndarray) -> np.ndarray:
+    lon = coords[:, 0]
+    lat = np.clip(coords[:, 1], -85.0511, 85.0511)
+    x = lon * ORIGIN_SHIFT / 180.0
+    y = EARTH_RADIUS * np.log(np.tan(math.pi / 4 + np.radians(lat) / 2))
+    return np.column_stack([x, y])
+
+
+def tile_bounds(zoom: int, x: int, y: int) -> tuple:
+    size = 2 * ORIGIN_SHIFT / (2 ** zoom)
+    min_x = -ORIGIN_SHIFT + x * size
+    max_y = ORIGIN_SHIFT - y * size
+    return min_x, max_y - size, min_x + size, max_y
+
+
+def tiles_for_bounds(bounds: tuple, zoom: int):
+    n = 2 ** zoom
+    size = 2 * ORIGIN_SHIFT / n
+    min_x, min_y, max_x, max_y = bounds
+    x0 = max(0, int((min_x + ORIGIN_SHIFT) // size))
+    x1 = min(n - 1, int((max_x + ORIGIN_SHIFT) // size))
+    y0 = max(0, int((ORIGIN_SHIFT - max_y) // size))
+    y1 = min(n - 1, int((ORIGIN_SHIFT - min_y) // size))
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield x, y
+
+
+def load_edges(db_path: str, city: str | None = None):
+    db = sqlite3.connect(db_path)
+    if city is None:
+        rows = db.execute(f"SELECT id, geom FROM {LAYER_NAME}")
+    else:
+        rows = db.execute(f"SELECT id, geom FROM {LAYER_NAME} WHERE city = ?", (city,))
+
+    ids = []
+    geometries = []
+    for edge_id, geom in rows:
+        ids.append(edge_id)
+        geometries.append(shapely.geometry.shape(json.loads(geom)))
+    db.close()
+
+    geometries = shapely.transform(geometries, lon_lat_to_mercator)
+    return ids, geometries
+
+
+def init_worker(db_path: str, city: str | None):
+    global _geometries, _ids, _tree
+    _ids, _geometries = load_edges(db_path, city)
+    _tree = shapely.STRtree(_geometries)
+
+
+def encode_tile(tile: tuple):
+    zoom, x, y = tile
+    bounds = tile_bounds(zoom, x, y)
+    clip = shapely.geometry.box(*bounds)
+
+    features = []
+    for index in _tree.query(clip, predicate="intersects"):
+        clipped = shapely.intersection(_geometries[index], clip)
+        if clipped.is_empty or clipped.length == 0:
+            continue
+        features.append({"geometry": clipped, "properties": {}, "id": _ids[index]})
+
+    if not features:
+        return zoom, x, y, None
+
+    data = mapbox_vector_tile.encode(
+        [{"name": LAYER_NAME, "features": features}],
+        default_options={"quantize_bounds": bounds, "extents": EXTENT},
+    )
+    return zoom, x, y, gzip.compress(data)
+
+
+def create_mbtiles(path: str, min_zoom: int, max_zoom: int, lon_lat_bounds: tuple) -> TileStore:
+    if os.path.exists(path):
+        os.remove(path)
+
+    store = TileStore(path)
+    store.db.execute("PRAGMA journal_mode = OFF")
+    store.db.execute("PRAGMA synchronous = OFF")
+
+    west, south, east, north = lon_lat_bounds
+    vector_layers = [{"id": LAYER_NAME, "fields": {}, "minzoom": min_zoom, "maxzoom": max_zoom}]
+    metadata = {
+        "name": LAYER_NAME,
+        "format": "pbf",
+        "type": "overlay",
+        "minzoom": str(min_zoom),
+        "maxzoom": str(max_zoom),
+        "bounds": f"{west},{south},{east},{north}",
+        "center": f"{(west + east) / 2},{(south + north) / 2},{min_zoom}",
+        "json": json.dumps({"vector_layers": vector_layers}),
+    }
+    store.db.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", metadata.items())
+    return store
+
+
+def generate(db_path: str, output: str, min_zoom: int, max_zoom: int, workers: int, city: str | None):
+    ids, geometries = load_edges(db_path, city)
+    print(f"Loaded {len(ids)} edges from {db_path}")
+    if not ids:
+        return
+
+    extent = shapely.total_bounds(geometries)
+    mercator_bounds = [geometry.bounds for geometry in geometries]
+    lon_lat_bounds = (
+        extent[0] / ORIGIN_SHIFT * 180.0,
+        math.degrees(2 * math.atan(math.exp(extent[1] / EARTH_RADIUS)) - math.pi / 2),
+        extent[2] / ORIGIN_SHIFT * 180.0,
+        math.degrees(2 * math.atan(math.exp(extent[3] / EARTH_RADIUS)) - math.pi / 2),
+    )
+
+    store = create_mbtiles(output, min_zoom, max_zoom, lon_lat_bounds)
+    t = time.time()
+    written = 0
+    total_bytes = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(db_path, city)) as executor:
+        for zoom in range(min_zoom, max_zoom + 1):
+            candidates = set()
+            for bounds in mercator_bounds:
+                candidates.update(tiles_for_bounds(bounds, zoom))
+
+            tiles = ((zoom, x, y) for x, y in sorted(candidates))
+            for z, x, y, data in executor.map(encode_tile, tiles, chunksize=256):
+                if data is None:
+                    continue
+                store.put(z, x, y, data)
+                total_bytes += len(data)
+                written += 1
+            store.commit()
+            print(f"Zoom {zoom}: {len(candidates)} candidates, {written} tiles written so far, "
+                  f"{total_bytes / 1e6:.1f} MB, {time.time() - t:.1f}s")
+
+    print_stats(store.stats())
+    store.close()
+    print(f"Done! Wrote {written} tiles to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate an MBTiles archive of road edges without a tile server")
+    parser.add_argument("--db", default="data.db", help="Network DB containing the all_cities table")
+    parser.add_argument("--output", default="all_cities.mbtiles")
+    parser.add_argument("--min-zoom", type=int, default=7)
+    parser.add_argument("--max-zoom", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--city", default=None, help="Only include edges for this city")
+    args = parser.parse_args()
+
+    generate(args.db, args.output, args.min_zoom, args.max_zoom, args.workers, args.city)
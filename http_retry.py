@@ -0,0 +1,85 @@
+import asyncio
+import contextlib
+import datetime
+import email.utils
+import math
+import os
+import random
+import tempfile
+
+import aiohttp
+
+# Retries and atomic downloads shared by the tile prefill and the animation frame capture
+
+# mkstemp creates files readable only by their owner; written files get the usual umask permissions instead
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class RetryableStatus(Exception):
+    def __init__(self, status: int, retry_after: float | None = None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+RETRYABLE_ERRORS = (RetryableStatus, asyncio.TimeoutError, aiohttp.ClientError)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    # Retry-After is either a number of seconds or an HTTP date. None when it is missing or malformed, so the
+    # caller falls back to its own backoff.
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        return max(0.0, seconds) if math.isfinite(seconds) else None
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def raise_for_overload(response: aiohttp.ClientResponse):
+    if response.status == 429 or response.status >= 500:
+        raise RetryableStatus(response.status, parse_retry_after(response.headers.get("Retry-After")))
+
+
+async def with_retries(send, retries: int, backoff: float):
+    # Awaits send(attempt) until it returns. RetryableStatus, timeouts and connection errors are retried after
+    # Retry-After or a jittered exponential backoff, and the last one is raised after `retries` retries. Any other
+    # exception fails at once.
+    for attempt in range(1, retries + 2):
+        try:
+            return await send(attempt)
+        except RETRYABLE_ERRORS as e:
+            if attempt > retries:
+                raise
+            delay = e.retry_after if isinstance(e, RetryableStatus) else None
+        if delay is None:
+            delay = backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+        await asyncio.sleep(delay)
+
+
+@contextlib.contextmanager
+def atomic_file(path: str):
+    # A temporary file next to `path` that replaces it only when the block completes, so an interrupted write
+    # never leaves a partial file behind
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f"{os.path.basename(path)}.",
+                                    suffix=".tmp")
+    try:
+        os.fchmod(fd, 0o666 & ~UMASK)
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from collections import Counter
+
+import shapely
+import shapely.geometry
+
+from prefill_cache import Explore, add_fetch_arguments, lat_lon_to_tile, make_prefiller, polygon_tiles, \
+    print_concurrency, tile_path
+from prefill_metrics import print_metrics
+from tile_inventory import TileInventory
+
+# Diffs two versions of the network DB and refreshes only the cached tiles that the changed edges touch, instead
+# of wiping and re-prefilling the whole cache.
+
+MIN_ZOOM = 7
+MAX_ZOOM = 16
+
+
+def load_edges(db_path: str) -> dict:
+    db = sqlite3.connect(db_path)
+    edges = {edge_id: json.loads(geom) for edge_id, geom in db.execute("SELECT id, geom FROM all_cities")}
+    db.close()
+    return edges
+
+
+def changed_geometries(old: dict, new: dict) -> tuple:
+    # Both the old and the new geometry of a modified edge are returned: tiles it left need the edge removed
+    added = new.keys() - old.keys()
+    removed = old.keys() - new.keys()
+    modified = {edge_id for edge_id in old.keys() & new.keys() if old[edge_id] != new[edge_id]}
+
+    geometries = [shapely.geometry.shape(new[edge_id]) for edge_id in added | modified]
+    geometries += [shapely.geometry.shape(old[edge_id]) for edge_id in removed | modified]
+    return geometries, len(added), len(removed), len(modified)
+
+
+def touched_tiles(geometries: list, min_zoom: int, max_zoom: int) -> set:
+    changed = shapely.union_all(geometries)
+    west, south, east, north = changed.bounds
+    x0, y0 = lat_lon_to_tile(north, west, min_zoom)
+    x1, y1 = lat_lon_to_tile(south, east, min_zoom)
+    seeds = [Explore(min_zoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+    return polygon_tiles(changed, seeds, max_zoom)
+
+
+def invalidate(inventory: TileInventory, tiles: set) -> int:
+    deleted = 0
+    for tile in tiles:
+        path = tile_path(inventory.cache_dir, tile)
+        if os.path.exists(path):
+            os.remove(path)
+            deleted += 1
+        inventory.remove(tile.key())
+        # A changed edge may land in a tile the prefill had pruned as empty
+        inventory.unmark_empty(tile.key())
+    inventory.commit()
+    return deleted
+
+
+async def refetch(args, inventory: TileInventory, tiles: list):
+    prefiller = make_prefiller(args, inventory)
+    async with prefiller:
+        await prefiller.run(tiles)
+    return prefiller
+
+
+def main(args):
+    old = load_edges(args.old_db)
+    new = load_edges(args.new_db)
+    geometries, added, removed, modified = changed_geometries(old, new)
+    print(f"{added} edges added, {removed} removed, {modified} modified")
+    if not geometries:
+        return
+
+    tiles = touched_tiles(geometries, args.min_zoom, args.max_zoom)
+    per_zoom = Counter(tile.zoom for tile in tiles)
+    print(f"{len(tiles)} tiles touched: " + ", ".join(f"z{zoom}: {count}" for zoom, count in sorted(per_zoom.items())))
+    if args.dry_run:
+        return
+
+    inventory = TileInventory(args.cache_dir).load()
+    deleted = invalidate(inventory, tiles)
+    print(f"Deleted {deleted} cached tiles")
+
+    t = time.monotonic()
+    try:
+        prefiller = asyncio.run(refetch(args, inventory, sorted(tiles, key=Explore.key)))
+    finally:
+        inventory.close()
+    print(f"Done! Refetched {prefiller.completed} tiles, {prefiller.bytes_written / 1e6:.1f} MB "
+          f"in {time.monotonic() - t:.1f}s, {len(prefiller.failed)} failed")
+    print_metrics(prefiller.metrics)
+    print_concurrency(prefiller.limiter)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the cached tiles touched by edges that changed between "
+                                                 "two versions of the network DB")
+    parser.add_argument("old_db")
+    parser.add_argument("new_db")
+    add_fetch_arguments(parser)
+    parser.add_argument("--min-zoom", type=int, default=MIN_ZOOM)
+    parser.add_argument("--max-zoom", type=int, default=MAX_ZOOM)
+    parser.add_argument("--dry-run", action="store_true", help="Only report the tiles that would be refreshed")
+    main(parser.parse_args())
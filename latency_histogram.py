@@ -0,0 +1,108 @@
+import math
+from collections import Counter
+
+# HDR-style log-linear latency histogram. Values are recorded in microseconds; below 2^SUB_BUCKET_BITS every value
+# has its own bucket, above that each power of two is split into 2^(SUB_BUCKET_BITS - 1) buckets, which keeps the
+# relative error under 0.1% from 1us to hours in a few thousand sparse buckets. Histograms with the same layout
+# merge exactly by adding counts, so per-process or per-interval histograms can be combined.
+
+SUB_BUCKET_BITS = 11
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+
+
+def bucket_index(value: int) -> int:
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return shift * SUB_BUCKET_HALF + (value >> shift)
+
+
+def bucket_bounds(index: int) -> tuple:
+    # Lowest and highest value that land in the bucket
+    if index < SUB_BUCKET_COUNT:
+        return index, index
+    shift = index // SUB_BUCKET_HALF - 1
+    lowest = (index - shift * SUB_BUCKET_HALF) << shift
+    return lowest, lowest + (1 << shift) - 1
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = Counter()
+        self.count = 0
+        self.total_us = 0
+        self.min_us = None
+        self.max_us = 0
+
+    def record(self, seconds: float, count: int = 1):
+        value = max(0, int(round(seconds * 1e6)))
+        self.counts[bucket_index(value)] += count
+        self.count += count
+        self.total_us += value * count
+        self.min_us = value if self.min_us is None else min(self.min_us, value)
+        self.max_us = max(self.max_us, value)
+
+    def merge(self, other: "LatencyHistogram"):
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total_us += other.total_us
+        if other.min_us is not None:
+            self.min_us = other.min_us if self.min_us is None else min(self.min_us, other.min_us)
+        self.max_us = max(self.max_us, other.max_us)
+        return self
+
+    def value_at_rank(self, rank: int) -> float:
+        # Highest equivalent value of the rank-th smallest recorded value (1-based), in seconds
+        if self.count == 0:
+            return math.nan
+        rank = min(max(rank, 1), self.count)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(bucket_bounds(index)[1], self.max_us) / 1e6
+        return self.max_us / 1e6
+
+    def percentile(self, percent: float) -> float:
+        return self.value_at_rank(math.ceil(percent / 100 * self.count))
+
+    def mean(self) -> float:
+        return self.total_us / self.count / 1e6 if self.count else math.nan
+
+    def values(self):
+        # (representative value in seconds, count) per bucket, in increasing order
+        for index in sorted(self.counts):
+            lowest, highest = bucket_bounds(index)
+            yield (lowest + highest) / 2e6, self.counts[index]
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.mean(),
+            "min": (self.min_us or 0) / 1e6,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p99.9": self.percentile(99.9),
+            "max": self.max_us / 1e6,
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "counts": {str(index): count for index, count in self.counts.items()},
+            "count": self.count,
+            "total_us": self.total_us,
+            "min_us": self.min_us,
+            "max_us": self.max_us,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LatencyHistogram":
+        histogram = cls()
+        histogram.counts = Counter({int(index): count for index, count in data["counts"].items()})
+        histogram.count = data["count"]
+        histogram.total_us = data["total_us"]
+        histogram.min_us = data["min_us"]
+        histogram.max_us = data["max_us"]
+        return histogram
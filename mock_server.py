@@ -0,0 +1,132 @@
+import argparse
+import asyncio
+import contextlib
+import gzip
+import json
+import math
+import random
+import zlib
+from collections import OrderedDict
+
+from aiohttp import web
+
+# Local stand-in for the tile server so the prefill tooling can be exercised without t-rex or the Rust backend.
+
+
+def tile_body(z: int, x: int, y: int) -> bytes:
+    rng = random.Random(zlib.crc32(f"{z}/{x}/{y}".encode()))
+    return bytes(rng.getrandbits(8) for _ in range(rng.randint(200, 4000)))
+
+
+def is_empty_tile(z: int, x: int, y: int, percent: float) -> bool:
+    # Emptiness is inherited by descendants, like water or parkland in a real tileset
+    while z >= 9:
+        if zlib.crc32(f"empty/{z}/{x}/{y}".encode()) % 100 < percent:
+            return True
+        z, x, y = z - 1, x // 2, y // 2
+    return False
+
+
+async def simulate_load(request: web.Request, cost: float = 1.0):
+    args = request.app["args"]
+    delay = max(0.0, random.gauss(args.latency_ms, args.jitter_ms)) * cost / 1000
+    # Requests beyond --capacity queue for a worker slot, like a saturated server
+    async with request.app["workers"]:
+        await asyncio.sleep(delay)
+    if random.random() < args.error_rate:
+        raise web.HTTPServiceUnavailable()
+
+
+async def get_tile(request: web.Request) -> web.Response:
+    await simulate_load(request)
+    z, x, y = (int(request.match_info[k]) for k in ("z", "x", "y"))
+    if is_empty_tile(z, x, y, request.app["args"].empty_percent):
+        body = gzip.compress(b"")
+    else:
+        body = gzip.compress(tile_body(z, x, y))
+    return web.Response(body=body, headers={
+        "Content-Encoding": "gzip",
+        "Content-Type": "application/x-protobuf",
+    })
+
+
+async def post_hello(request: web.Request) -> web.Response:
+    # Like the real /hello, work and response size grow with the search time and agencies (2h with the 13 agencies
+    # profiling.py sends costs --latency-ms)
+    body = await request.json()
+    search_time = body["maxSearchTime"]
+    # Same key and LRU policy as src/web_cache.rs; a hit only costs serializing the stored response
+    cache = request.app["response_cache"]
+    key = (max(0, round(body["latitude"] * 10000)), max(0, round(body["longitude"] * 10000)),
+           tuple(body["agencies"]), tuple(body["modes"]), body["startTime"], int(search_time),
+           body.get("transferCostSecs") or 0)
+    if key in cache:
+        cache.move_to_end(key)
+        await simulate_load(request, 0.05)
+        return web.Response(text=cache[key], content_type="application/json")
+    await simulate_load(request, search_time / 7200 * (0.5 + len(body["agencies"]) / 26)
+                        * origin_cost(body["latitude"], body["longitude"]))
+    rng = random.Random(zlib.crc32(f"{body['latitude']:.4f},{body['longitude']:.4f}".encode()))
+    edge_times = {str(rng.randrange(1_000_000)): rng.randrange(int(search_time))
+                  for _ in range(int(search_time) // 40)}
+    request_id = {"rs_list_index": request.app["next_request_id"], "city": "Toronto"}
+    request.app["next_request_id"] += 1
+    text = json.dumps({"request_id": request_id, "edge_times": edge_times})
+    if request.app["args"].cache_size:
+        cache[key] = text
+        if len(cache) > request.app["args"].cache_size:
+            cache.popitem(last=False)
+    return web.Response(text=text, content_type="application/json")
+
+
+async def post_details(request: web.Request) -> web.Response:
+    body = await request.json()
+    await simulate_load(request, 0.25)
+    if body["request_id"]["rs_list_index"] >= request.app["next_request_id"]:
+        raise web.HTTPBadRequest(text="Unknown request id")
+    return web.json_response({"details": [], "seconds": random.randrange(3600)})
+
+
+async def post_bike(request: web.Request) -> web.Response:
+    body = await request.json()
+    await simulate_load(request, 0.5)
+    return web.json_response({"points": [body["start"], body["end"]]})
+
+
+async def get_agencies(request: web.Request) -> web.Response:
+    return web.json_response([{"name": "TTC", "short_code": "TTC"}], headers={"Cache-Control": "max-age=18000"})
+
+
+def origin_cost(latitude: float, longitude: float) -> float:
+    # Searches from around Union Station reach far more of the network, so they cost up to 3x as much
+    distance = math.hypot(latitude - 43.6453, (longitude + 79.3806) * 0.72)
+    return 1 + 2 * math.exp(-(distance / 0.02) ** 2)
+
+
+def make_app(args) -> web.Application:
+    app = web.Application()
+    app["args"] = args
+    app["workers"] = asyncio.Semaphore(args.capacity) if args.capacity else contextlib.nullcontext()
+    app["next_request_id"] = 0
+    app["response_cache"] = OrderedDict()
+    app.router.add_post("/hello", post_hello)
+    app.router.add_post("/details", post_details)
+    app.router.add_post("/bike", post_bike)
+    app.router.add_get("/agencies", get_agencies)
+    app.router.add_get(r"/{layer}/{z:\d+}/{x:\d+}/{y:\d+}.{ext:pbf|bin}", get_tile)
+    app.router.add_get(r"/mvt/{layer}/{z:\d+}/{x:\d+}/{y:\d+}.{ext:pbf|bin}", get_tile)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in server for exercising prefill and profiling tools")
+    parser.add_argument("--port", type=int, default=6767)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--capacity", type=int, default=0, help="Requests served concurrently, 0 for unlimited")
+    parser.add_argument("--empty-percent", type=float, default=0.0,
+                        help="Chance that a tile at z9+ is empty, along with all of its descendants")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 503")
+    parser.add_argument("--cache-size", type=int, default=30, help="Entries in the /hello response cache")
+    args = parser.parse_args()
+    web.run_app(make_app(args), port=args.port)
@@ -1,19 +1,24 @@
+import argparse
+import asyncio
 import dataclasses
+import gzip
+import hashlib
 import os.path
-import pdb
-from concurrent.futures import as_completed
+import re
+import sys
+import time
+from collections import Counter, defaultdict
 
 import math
-import queue
-
-import sys
 
+import aiohttp
 import shapely.geometry
-from requests_futures.sessions import FuturesSession
-from shapely.geometry import Point
+import shapely.prepared
 
 from download_gpkg import SAN_FRAN, create_poly_from_geojson
-url = sys.argv[1]
+from http_retry import RETRYABLE_ERRORS, RetryableStatus, atomic_file, raise_for_overload, with_retries
+from prefill_metrics import PrefillMetrics, print_metrics
+from tile_inventory import TileInventory, print_coverage
 
 
 def lat_lon_to_tile(lat, lon, zoom):
@@ -49,8 +54,17 @@ class Explore:
     def __hash__(self):
         return hash((self.zoom, self.x, self.y))
 
+    def children(self):
+        for dx in (0, 1):
+            for dy in (0, 1):
+                yield Explore(self.zoom + 1, 2 * self.x + dx, 2 * self.y + dy)
+
+    def bounds(self):
+        return tile_to_lat_lon_bounds(self.x, self.y, self.zoom)
+
+    def key(self) -> tuple:
+        return self.zoom, self.x, self.y
 
-to_explore = queue.Queue()
 
 VANCOUVER_TL = (49.328910726698005, -123.25959613136175)
 VANCOUVER_BR = (49.15112007739324, -122.86397283811988)
@@ -75,75 +89,528 @@ SF3 = 37.803398137952186, -122.22809341889861
 CHICAGO = 41.88502620493033, -87.64866240164858
 CHICAGO2 = 42.0965437845508, -87.73648980584558
 
-# to_explore.put(Explore.from_latlong(*NYC_1, 7))
-# to_explore.put(Explore.from_latlong(*NYC_2, 7))
-# to_explore.put(Explore.from_latlong(*VANCOUVER_TL, 7))
-# to_explore.put(Explore.from_latlong(*VANCOUVER_BR, 7))
-# to_explore.put(Explore.from_latlong(*MONTREAL_1, 7))
-# to_explore.put(Explore.from_latlong(*MONTREAL_2, 7))
-# to_explore.put(Explore.from_latlong(*PARIS_1, 7))
-# to_explore.put(Explore.from_latlong(*TORONTO, 7))
-# to_explore.put(Explore.from_latlong(*SAN_FRANCISCO, 8))
-# to_explore.put(Explore.from_latlong(*SAN_FRANCISCO1, 8))
-to_explore.put(Explore.from_latlong(*SF3, 7))
-to_explore.put(Explore.from_latlong(*SF2, 7))
-
-# to_explore.put(Explore.from_latlong(*LONDON_1, 7))
-
-to_explore_calculated = set()
-MAX_ZOOM = 16
-while not to_explore.empty():
-    explore = to_explore.get_nowait()
-    to_explore_calculated.add(explore)
-    # Calculate tiles to max zoom
-    for cur_zoom in range(explore.zoom + 1, MAX_ZOOM + 1):
-        zoom_diff = cur_zoom - explore.zoom
-        multiplier = int(math.pow(2, zoom_diff))
-
-        to_explore.put(Explore(cur_zoom, multiplier * explore.x, multiplier * explore.y))
-        to_explore.put(Explore(cur_zoom, multiplier * explore.x + 1, multiplier * explore.y))
-        to_explore.put(Explore(cur_zoom, multiplier * explore.x, multiplier * explore.y + 1))
-        to_explore.put(Explore(cur_zoom, multiplier * explore.x + 1, multiplier * explore.y + 1))
-
+SEEDS = [
+    # Explore.from_latlong(*NYC_1, 7),
+    # Explore.from_latlong(*NYC_2, 7),
+    # Explore.from_latlong(*VANCOUVER_TL, 7),
+    # Explore.from_latlong(*VANCOUVER_BR, 7),
+    # Explore.from_latlong(*MONTREAL_1, 7),
+    # Explore.from_latlong(*MONTREAL_2, 7),
+    # Explore.from_latlong(*PARIS_1, 7),
+    # Explore.from_latlong(*TORONTO, 7),
+    # Explore.from_latlong(*SAN_FRANCISCO, 8),
+    # Explore.from_latlong(*SAN_FRANCISCO1, 8),
+    Explore.from_latlong(*SF3, 7),
+    Explore.from_latlong(*SF2, 7),
+    # Explore.from_latlong(*LONDON_1, 7),
+]
 
+MAX_ZOOM = 16
 SF_POLY = create_poly_from_geojson(SAN_FRAN)
 
-def pre_check(coord: Explore):
-    latlng = tile_to_lat_lon_bounds(coord.x, coord.y, coord.zoom)
-    if SF_POLY.intersects(latlng):
-        return os.path.exists(f"vancouver-cache/all_cities/{coord.zoom}/{coord.x}/{coord.y}.pbf")
-    else:
-        return True
-    # if os.path.exists(f"vancouver-cache/all_cities/{coord.zoom}/{coord.x}/{coord.y}.pbf"):
-    #     os.remove(f"vancouver-cache/all_cities/{coord.zoom}/{coord.x}/{coord.y}.pbf")
-    # return True
-with FuturesSession() as session:
-    futures = []
-    completed = 0
-    for coord in to_explore_calculated:
-        assert coord.zoom >= 7
-
-        if pre_check(coord):
-            completed += 1
-            continue
-        r = session.get(f'{url}/{coord.zoom}/{coord.x}/{coord.y}.pbf')
-        futures.append(r)
-
-        if len(futures) > 80:
-            for future in as_completed(futures):
-                resp = future.result()
-#                 resp.raise_for_status()
-                if completed % 100 == 0:
-                    print("Completed! ", resp, len(resp.content), f"{completed} out of {len(to_explore_calculated)}")
-                completed += 1
-            futures = []
-
-    for future in as_completed(futures):
-        resp = future.result()
-        resp.raise_for_status()
-        print("Completed! ", resp, len(resp.content), f"{completed} out of {len(to_explore_calculated)}")
-        completed += 1
-    session.executor.shutdown(wait = True)
 
+CACHE_DIR = "vancouver-cache/all_cities"
+CHUNK_SIZE = 64 * 1024
+
+
+def tile_path(cache_dir: str, coord: Explore) -> str:
+    return os.path.join(cache_dir, str(coord.zoom), str(coord.x), f"{coord.y}.pbf")
+
+
+class TileFetchError(Exception):
+    pass
+
+
+class HashingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.sha1.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+async def write_tile(response: aiohttp.ClientResponse, path: str) -> tuple:
+    # The server serves tiles from disk with `Content-Encoding: gzip` as-is, so store gzip bytes. The session
+    # doesn't auto-decompress; bodies that arrive uncompressed are gzipped while streaming.
+    # Returns the stored size and sha1 for the inventory.
+    with atomic_file(path) as f:
+        stored = HashingWriter(f)
+        if response.headers.get("Content-Encoding", "").lower() == "gzip":
+            out = stored
+        else:
+            out = gzip.GzipFile(fileobj=stored, mode="wb")
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            out.write(chunk)
+        if out is not stored:
+            out.close()
+    return stored.size, stored.sha1.hexdigest()
+
+
+class AdaptiveLimiter:
+    # AIMD on the in-flight limit. Every window of roughly `limit` completions the p95 latency is compared with
+    # the target: any 429/5xx/timeout or a slow p95 cuts the limit multiplicatively, otherwise it grows by one.
+    # With floor == ceiling this is a plain semaphore.
+    def __init__(self, initial: int, floor: int, ceiling: int, target_p95: float, decrease: float = 0.75,
+                 min_window: int = 20):
+        self.floor = floor
+        self.ceiling = max(floor, ceiling)
+        self.limit = min(max(initial, self.floor), self.ceiling)
+        self.target_p95 = target_p95
+        self.decrease = decrease
+        self.min_window = min_window
+
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.latencies = []
+        self.overloaded = 0
+        self.history = [(time.monotonic(), self.limit)]
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def record(self, latency: float, overloaded: bool = False):
+        if self.floor == self.ceiling:
+            return
+        self.latencies.append(latency)
+        self.overloaded += overloaded
+        if len(self.latencies) < max(self.limit, self.min_window):
+            return
+
+        self.latencies.sort()
+        p95 = self.latencies[int(0.95 * (len(self.latencies) - 1))]
+        if self.overloaded or p95 > self.target_p95:
+            new_limit = max(self.floor, int(self.limit * self.decrease))
+            if new_limit != self.limit:
+                print(f"Reducing concurrency {self.limit} -> {new_limit} "
+                      f"(p95 {p95 * 1000:.0f}ms, {self.overloaded} overloaded responses)")
+        else:
+            new_limit = min(self.ceiling, self.limit + 1)
+        self.latencies = []
+        self.overloaded = 0
+
+        if new_limit != self.limit:
+            self.limit = new_limit
+            self.history.append((time.monotonic(), self.limit))
+
+    def settled(self) -> float:
+        # Time-weighted mean limit over the second half of the run
+        end = time.monotonic()
+        start = self.history[0][0] + (end - self.history[0][0]) / 2
+        total = 0.0
+        for (t, limit), (t_next, _) in zip(self.history, self.history[1:] + [(end, None)]):
+            overlap = min(t_next, end) - max(t, start)
+            if overlap > 0:
+                total += overlap * limit
+        return total / (end - start) if end > start else float(self.limit)
 
 
+@dataclasses.dataclass
+class TileResult:
+    tile: Explore
+    status: int
+    size: int
+    sha1: str
+    latency: float
+    attempts: int
+
+
+class TilePrefiller:
+    def __init__(self, url: str, limiter: AdaptiveLimiter, cache_dir: str = CACHE_DIR, retries: int = 4,
+                 backoff: float = 0.5, timeout: float = 60.0, inventory: TileInventory | None = None,
+                 metrics: PrefillMetrics | None = None, metrics_paths: tuple = (None, None),
+                 metrics_interval: float = 30.0):
+        self.url = url.rstrip("/")
+        self.cache_dir = cache_dir
+        self.limiter = limiter
+        self.inventory = inventory
+        self.metrics = metrics or PrefillMetrics()
+        self.metrics_paths = metrics_paths
+        self.metrics_interval = metrics_interval
+        self.metrics_task = None
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.completed = 0
+        self.failed = []
+        self.bytes_written = 0
+        self.total = 0
+        self.start = None
+
+    async def fetch(self, session: aiohttp.ClientSession, tile: Explore) -> TileResult:
+        url = f"{self.url}/{tile.zoom}/{tile.x}/{tile.y}.pbf"
+
+        async def attempt_fetch(attempt: int) -> TileResult:
+            t = time.monotonic()
+            try:
+                async with session.get(url, headers={"Accept-Encoding": "gzip"}) as response:
+                    raise_for_overload(response)
+                    if response.status >= 400:
+                        self.metrics.record(tile.key(), response.status, time.monotonic() - t)
+                        raise TileFetchError(f"{url}: HTTP {response.status}")
+                    size, sha1 = await write_tile(response, tile_path(self.cache_dir, tile))
+                    latency = time.monotonic() - t
+                    self.limiter.record(latency)
+                    self.metrics.record(tile.key(), response.status, latency, size)
+                    return TileResult(tile, response.status, size, sha1, latency, attempt)
+            except RetryableStatus as e:
+                self.limiter.record(time.monotonic() - t, overloaded=True)
+                self.metrics.record(tile.key(), e.status, time.monotonic() - t)
+                raise
+            except asyncio.TimeoutError:
+                self.limiter.record(time.monotonic() - t, overloaded=True)
+                self.metrics.record(tile.key(), "timeout", time.monotonic() - t)
+                raise
+            except aiohttp.ClientError:
+                self.metrics.record(tile.key(), "error", time.monotonic() - t)
+                raise
+
+        try:
+            return await with_retries(attempt_fetch, self.retries, self.backoff)
+        except RETRYABLE_ERRORS as e:
+            raise TileFetchError(f"{url}: {e!r} after {self.retries + 1} attempts") from e
+
+    def on_result(self, result: TileResult):
+        self.completed += 1
+        self.bytes_written += result.size
+        if self.inventory is not None:
+            self.inventory.add(result.tile.key(), result.size, result.sha1)
+        if self.completed % 100 == 0:
+            rate = self.completed / (time.monotonic() - self.start)
+            print("Completed! ", f"{self.completed} out of {self.total}", f"{rate:.1f} tiles/s",
+                  f"{self.bytes_written / 1e6:.1f} MB", f"concurrency {self.limiter.limit}")
+
+    def on_failure(self, tile: Explore, error: Exception):
+        self.failed.append(tile)
+        print("Failed! ", error)
+
+    async def run_one(self, session: aiohttp.ClientSession, tile: Explore):
+        try:
+            self.on_result(await self.fetch(session, tile))
+        except TileFetchError as e:
+            self.on_failure(tile, e)
+        finally:
+            await self.limiter.release()
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.limiter.ceiling, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False)
+        if any(self.metrics_paths):
+            self.metrics_task = asyncio.create_task(
+                self.metrics.write_periodically(self.metrics_interval, *self.metrics_paths))
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+        if any(self.metrics_paths):
+            self.metrics.write(*self.metrics_paths)
+
+    async def run(self, tiles: list, deadline: float | None = None):
+        # Sliding window: a new request starts as soon as any in-flight request finishes, so one slow tile
+        # only holds one slot instead of stalling a whole batch. Past the deadline no new requests are started.
+        self.total += len(tiles)
+        self.start = self.start or time.monotonic()
+        in_flight = set()
+        for tile in tiles:
+            await self.limiter.acquire()
+            if deadline is not None and time.monotonic() > deadline:
+                await self.limiter.release()
+                break
+            task = asyncio.create_task(self.run_one(self.session, tile))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        await asyncio.gather(*in_flight)
+
+
+def morton_code(x: int, y: int, bits: int) -> int:
+    code = 0
+    for bit in range(bits):
+        code |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+    return code
+
+
+def mix64(value: int) -> int:
+    # splitmix64 finalizer
+    value = (value + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return value ^ (value >> 31)
+
+
+@dataclasses.dataclass(frozen=True)
+class Shard:
+    # Tiles at or below `zoom` are assigned by their ancestor block at `zoom`, so every shard owns whole subtrees,
+    # i.e. contiguous ranges of the z-order curve. Coarser tiles are few and every shard fetches them, so each one
+    # knows which of them are empty and prunes the same subtrees as an unsharded run.
+    index: int = 0
+    count: int = 1
+    zoom: int = 12
+
+    @classmethod
+    def parse(cls, spec: str, zoom: int = 12):
+        index, count = (int(part) for part in spec.split("/"))
+        if not 0 <= index < count:
+            raise ValueError(f"Shard {spec} must be i/N with 0 <= i < N")
+        return cls(index, count, zoom)
+
+    def owner(self, key: tuple) -> int:
+        # Coarse tiles are reported under shard 0, though every shard owns them
+        zoom, x, y = key
+        if zoom < self.zoom:
+            return 0
+        shift = zoom - self.zoom
+        return mix64(morton_code(x >> shift, y >> shift, self.zoom)) % self.count
+
+    def owns(self, key: tuple) -> bool:
+        return self.count == 1 or key[0] < self.zoom or self.owner(key) == self.index
+
+
+def polygon_levels(polygon, seeds, max_zoom: int):
+    # Yields the polygon-intersecting tiles of each zoom level; send() the tiles to descend into for the next one.
+    # Children of a tile fully inside the polygon are inside too, so they skip the intersection test.
+    prepared = shapely.prepared.prep(polygon)
+    seeds_by_zoom = defaultdict(set)
+    for seed in seeds:
+        seeds_by_zoom[seed.zoom].add(seed)
+
+    parents = set()
+    inside = set()
+    for zoom in range(min(seeds_by_zoom), max_zoom + 1):
+        candidates = [(child, tile in inside) for tile in parents for child in tile.children()]
+        candidates += [(seed, False) for seed in seeds_by_zoom[zoom]]
+        level = set()
+        contained = set()
+        for tile, parent_inside in candidates:
+            if parent_inside or prepared.contains(tile.bounds()):
+                contained.add(tile)
+                level.add(tile)
+            elif prepared.intersects(tile.bounds()):
+                level.add(tile)
+        parents = yield zoom, level
+        inside = contained & parents
+
+
+def polygon_tiles(polygon, seeds, max_zoom: int) -> set:
+    # Every polygon-intersecting tile from the seeds down to max_zoom, without pruning
+    tiles = set()
+    levels = polygon_levels(polygon, seeds, max_zoom)
+    zoom, level = next(levels)
+    while True:
+        tiles |= level
+        try:
+            zoom, level = levels.send(level)
+        except StopIteration:
+            return tiles
+
+
+async def prefill_by_zoom(prefiller: TilePrefiller, inventory: TileInventory, polygon, seeds, max_zoom: int,
+                          empty_bytes: int, shard: Shard = Shard()) -> set:
+    # Breadth-first by zoom: a level is fetched completely before the next one is enumerated, and only children
+    # of tiles that came back with more than `empty_bytes` are descended into. Empty tiles are persisted in the
+    # inventory so later runs prune the same subtrees without refetching.
+    visited = set()
+    levels = polygon_levels(polygon, seeds, max_zoom)
+    zoom, level = next(levels)
+    while True:
+        # Other shards' blocks are dropped with their whole subtree
+        level = {tile for tile in level if shard.owns(tile.key())}
+        missing = sorted((tile for tile in level if tile.key() not in inventory), key=Explore.key)
+        await prefiller.run(missing)
+        visited |= level
+
+        empty = {tile for tile in level if inventory.is_empty(tile.key(), empty_bytes)}
+        print(f"z{zoom}: {len(level)} tiles, fetched {len(missing)}, {len(empty)} empty")
+        try:
+            zoom, level = levels.send(level - empty)
+        except StopIteration:
+            return visited
+
+
+def verify_coverage(inventory: TileInventory, polygon, seeds, max_zoom: int, empty_bytes: int,
+                    shard_count: int = 1, shard_zoom: int = 12) -> int:
+    # Walks the same pruned levels as the prefill without fetching and reports the tiles that are still missing.
+    # Missing tiles have unknown emptiness, so their children are expected too.
+    missing_by_shard = Counter()
+    missing_total = 0
+    levels = polygon_levels(polygon, seeds, max_zoom)
+    zoom, level = next(levels)
+    while True:
+        missing = [tile for tile in level if tile.key() not in inventory]
+        for tile in missing:
+            missing_by_shard[Shard(0, shard_count, shard_zoom).owner(tile.key())] += 1
+        missing_total += len(missing)
+        print(f"z{zoom}: {len(level) - len(missing)} / {len(level)} present")
+
+        empty = {tile for tile in level if inventory.is_empty(tile.key(), empty_bytes)}
+        try:
+            zoom, level = levels.send(level - empty)
+        except StopIteration:
+            break
+
+    for index, count in sorted(missing_by_shard.items()):
+        print(f"Shard {index}/{shard_count}: {count} tiles missing")
+    print("Coverage complete" if missing_total == 0 else f"{missing_total} tiles missing")
+    return missing_total
+
+
+def make_limiter(args) -> AdaptiveLimiter:
+    floor = args.min_concurrency or args.concurrency
+    ceiling = args.max_concurrency or args.concurrency
+    return AdaptiveLimiter(args.concurrency, floor, ceiling, args.target_p95_ms / 1000)
+
+
+def make_prefiller(args, inventory: TileInventory) -> TilePrefiller:
+    return TilePrefiller(args.url, make_limiter(args), args.cache_dir, args.retries, args.backoff, args.timeout,
+                         inventory, PrefillMetrics(), (args.metrics_json, args.metrics_prom), args.metrics_interval)
+
+
+def print_concurrency(limiter: AdaptiveLimiter):
+    if limiter.floor == limiter.ceiling:
+        return
+    limits = [limit for _, limit in limiter.history]
+    print(f"Concurrency settled at {limiter.settled():.1f} (final {limiter.limit}, "
+          f"range {min(limits)}-{max(limits)}, {len(limits) - 1} adjustments)")
+
+
+# Matches `/mvt/...` requests in the warp `weblog` lines, e.g.
+# 1.2.3.4:5678 - "GET /mvt/all_cities/13/1309/3166.bin HTTP/1.1" 200 "-" "Mozilla/5.0" 1.2ms
+MVT_LOG_PATTERN = re.compile(r'"GET /mvt/(?:\w+/)?(\d+)/(\d+)/(\d+)(?:\.\w+)? ')
+
+
+def tile_popularity(log_paths: list) -> Counter:
+    popularity = Counter()
+    for path in log_paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", errors="replace") as f:
+            for line in f:
+                match = MVT_LOG_PATTERN.search(line)
+                if match:
+                    popularity[tuple(int(part) for part in match.groups())] += 1
+    return popularity
+
+
+def under_empty_tile(inventory: TileInventory, key: tuple) -> bool:
+    zoom, x, y = key
+    while zoom > 0:
+        zoom, x, y = zoom - 1, x // 2, y // 2
+        if (zoom, x, y) in inventory.empty:
+            return True
+    return False
+
+
+async def prefill_popular(prefiller: TilePrefiller, inventory: TileInventory, popularity: Counter, min_zoom: int,
+                          max_zoom: int, count: int | None, seconds: float | None, shard: Shard = Shard()):
+    # Most requested tiles first, within a count and/or time budget, before the exhaustive pass
+    total_requests = sum(popularity.values())
+    ranked = [key for key, _ in popularity.most_common()
+              if min_zoom <= key[0] <= max_zoom and shard.owns(key) and not under_empty_tile(inventory, key)]
+    ranked = ranked[:count] if count is not None else ranked
+    covered = sum(popularity[key] for key in ranked)
+    missing = [Explore(*key) for key in ranked if key not in inventory]
+    print(f"{len(popularity)} distinct tiles in access logs; warming the top {len(ranked)} "
+          f"({100 * covered / max(total_requests, 1):.1f}% of {total_requests} requests), {len(missing)} not cached")
+
+    completed = prefiller.completed
+    deadline = time.monotonic() + seconds if seconds is not None else None
+    await prefiller.run(missing, deadline)
+    print(f"Warmed {prefiller.completed - completed} popular tiles")
+
+
+async def run_prefill(args, prefiller: TilePrefiller, inventory: TileInventory) -> set:
+    shard = args.shard or Shard()
+    async with prefiller:
+        if args.access_log:
+            popularity = tile_popularity(args.access_log)
+            await prefill_popular(prefiller, inventory, popularity, min(seed.zoom for seed in SEEDS), MAX_ZOOM,
+                                  args.popular_count, args.popular_seconds, shard)
+        return await prefill_by_zoom(prefiller, inventory, SF_POLY, SEEDS, MAX_ZOOM, args.empty_bytes, shard)
+
+
+def main(args):
+    inventory = TileInventory(args.cache_dir)
+    if args.rescan or not inventory.exists:
+        inventory.scan()
+    else:
+        inventory.load()
+
+    if args.verify:
+        missing = verify_coverage(inventory, SF_POLY, SEEDS, MAX_ZOOM, args.empty_bytes,
+                                  args.shard.count if args.shard else 1, args.shard_zoom)
+        inventory.close()
+        sys.exit(1 if missing else 0)
+    if args.url is None:
+        sys.exit("A tile URL is required unless --verify is given")
+
+    prefiller = make_prefiller(args, inventory)
+    t = time.monotonic()
+    try:
+        visited = asyncio.run(run_prefill(args, prefiller, inventory))
+    finally:
+        inventory.close()
+    print(f"Done! {prefiller.completed} tiles, {prefiller.bytes_written / 1e6:.1f} MB in {time.monotonic() - t:.1f}s, "
+          f"{len(prefiller.failed)} failed")
+    print_coverage(inventory.coverage(tile.key() for tile in visited))
+    print_metrics(prefiller.metrics)
+    print_concurrency(prefiller.limiter)
+
+
+def add_fetch_arguments(parser: argparse.ArgumentParser, url_required: bool = True):
+    parser.add_argument("url", nargs=None if url_required else "?",
+                        help="Tile URL prefix, requests go to {url}/{z}/{x}/{y}.pbf")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--concurrency", type=int, default=64, help="Initial in-flight request limit")
+    parser.add_argument("--min-concurrency", type=int, default=None,
+                        help="Floor for adaptive concurrency (defaults to --concurrency)")
+    parser.add_argument("--max-concurrency", type=int, default=None,
+                        help="Ceiling for adaptive concurrency (defaults to --concurrency)")
+    parser.add_argument("--target-p95-ms", type=float, default=500.0,
+                        help="Adaptive concurrency backs off when p95 latency exceeds this")
+    parser.add_argument("--retries", type=int, default=4)
+    parser.add_argument("--backoff", type=float, default=0.5, help="Initial retry backoff in seconds")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request timeout in seconds")
+    parser.add_argument("--metrics-json", default=None, help="Write run metrics as JSON to this path")
+    parser.add_argument("--metrics-prom", default=None, help="Write run metrics as a Prometheus textfile to this path")
+    parser.add_argument("--metrics-interval", type=float, default=30.0,
+                        help="Seconds between metrics file updates during the run")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm the vector tile cache from a tile server")
+    add_fetch_arguments(parser, url_required=False)
+    parser.add_argument("--rescan", action="store_true", help="Rebuild the cache inventory from the directory tree")
+    parser.add_argument("--empty-bytes", type=int, default=50,
+                        help="Tiles stored in at most this many bytes count as empty and their descendants are skipped")
+    parser.add_argument("--access-log", action="append", default=[],
+                        help="Server log to rank tiles by popularity; popular tiles are warmed first. Repeatable")
+    parser.add_argument("--popular-count", type=int, default=None, help="Warm at most this many popular tiles")
+    parser.add_argument("--popular-seconds", type=float, default=None,
+                        help="Stop starting popular tiles after this many seconds")
+    parser.add_argument("--shard", default=None,
+                        help="Only prefill shard i of N (0-based, e.g. 2/8); shards can run on separate hosts")
+    parser.add_argument("--shard-zoom", type=int, default=12,
+                        help="Zoom of the blocks that are assigned to shards as whole subtrees")
+    parser.add_argument("--verify", action="store_true",
+                        help="Don't fetch; report tiles still missing from the (merged) cache and exit 1 if any")
+    args = parser.parse_args()
+    try:
+        args.shard = Shard.parse(args.shard, args.shard_zoom) if args.shard else None
+    except ValueError as e:
+        parser.error(str(e))
+    main(args)
@@ -0,0 +1,173 @@
+import asyncio
+import heapq
+import json
+import os
+import time
+from collections import Counter, defaultdict
+
+# Metrics for a prefill run: per-zoom latency and size histograms, status counts, throughput over time and the
+# slowest tiles. Written as JSON and as a Prometheus textfile (for node_exporter's textfile collector).
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+SIZE_BUCKETS = [64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+
+
+class Histogram:
+    def __init__(self, buckets: list):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        # Upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        return {
+            "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.counts)),
+            "sum": self.sum,
+            "count": self.count,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+    def prometheus(self, name: str, labels: str) -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class PrefillMetrics:
+    def __init__(self, slowest: int = 20):
+        self.start = time.monotonic()
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.size = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.statuses = Counter()
+        self.tiles = 0
+        self.bytes = 0
+        self.timeline = []
+        self.slowest_count = slowest
+        self.slowest = []
+
+    def record(self, tile: tuple, status, latency: float, size: int | None = None):
+        # One call per attempt; status is the HTTP status, or "timeout"/"error" when there was no response
+        zoom = tile[0]
+        self.statuses[str(status)] += 1
+        self.latency[zoom].observe(latency)
+        if size is None:
+            return
+
+        self.tiles += 1
+        self.bytes += size
+        self.size[zoom].observe(size)
+        entry = (latency, tile, size)
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+    def sample_throughput(self):
+        self.timeline.append((time.monotonic() - self.start, self.tiles, self.bytes))
+
+    def throughput(self) -> list:
+        samples = []
+        previous = (0.0, 0, 0)
+        for elapsed, tiles, size in self.timeline:
+            interval = max(elapsed - previous[0], 1e-9)
+            samples.append({
+                "elapsed_seconds": elapsed,
+                "tiles": tiles,
+                "bytes": size,
+                "tiles_per_second": (tiles - previous[1]) / interval,
+                "bytes_per_second": (size - previous[2]) / interval,
+            })
+            previous = (elapsed, tiles, size)
+        return samples
+
+    def to_dict(self) -> dict:
+        elapsed = time.monotonic() - self.start
+        return {
+            "elapsed_seconds": elapsed,
+            "tiles": self.tiles,
+            "bytes": self.bytes,
+            "tiles_per_second": self.tiles / elapsed if elapsed else 0.0,
+            "statuses": dict(self.statuses),
+            "latency_seconds": {zoom: self.latency[zoom].to_dict() for zoom in sorted(self.latency)},
+            "size_bytes": {zoom: self.size[zoom].to_dict() for zoom in sorted(self.size)},
+            "throughput": self.throughput(),
+            "slowest": [{"tile": "/".join(map(str, tile)), "latency_seconds": latency, "bytes": size}
+                        for latency, tile, size in sorted(self.slowest, reverse=True)],
+        }
+
+    def to_prometheus(self) -> str:
+        lines = [
+            "# TYPE prefill_request_duration_seconds histogram",
+        ]
+        for zoom in sorted(self.latency):
+            lines += self.latency[zoom].prometheus("prefill_request_duration_seconds", f'zoom="{zoom}"')
+        lines.append("# TYPE prefill_tile_size_bytes histogram")
+        for zoom in sorted(self.size):
+            lines += self.size[zoom].prometheus("prefill_tile_size_bytes", f'zoom="{zoom}"')
+        lines.append("# TYPE prefill_responses_total counter")
+        for status, count in sorted(self.statuses.items()):
+            lines.append(f'prefill_responses_total{{status="{status}"}} {count}')
+        lines.append("# TYPE prefill_tiles_total counter")
+        lines.append(f"prefill_tiles_total {self.tiles}")
+        lines.append("# TYPE prefill_bytes_total counter")
+        lines.append(f"prefill_bytes_total {self.bytes}")
+        lines.append("# TYPE prefill_elapsed_seconds gauge")
+        lines.append(f"prefill_elapsed_seconds {time.monotonic() - self.start}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path: str | None, prometheus_path: str | None):
+        self.sample_throughput()
+        for path, content in ((json_path, lambda: json.dumps(self.to_dict(), indent=2)),
+                              (prometheus_path, self.to_prometheus)):
+            if path is None:
+                continue
+            # Written atomically so a textfile collector never reads a partial file
+            with open(f"{path}.tmp", "w") as f:
+                f.write(content())
+            os.replace(f"{path}.tmp", path)
+
+    async def write_periodically(self, interval: float, json_path: str | None, prometheus_path: str | None):
+        while True:
+            await asyncio.sleep(interval)
+            self.write(json_path, prometheus_path)
+
+
+def print_metrics(metrics: PrefillMetrics, slowest: int = 5):
+    print("Responses:", ", ".join(f"{status}: {count}" for status, count in sorted(metrics.statuses.items())))
+    for zoom in sorted(metrics.latency):
+        latency = metrics.latency[zoom]
+        size = metrics.size[zoom]
+        mean_size = size.sum / size.count if size.count else 0
+        print(f"z{zoom}: {latency.count} requests, p50 <= {latency.quantile(0.5) * 1000:.0f}ms, "
+              f"p95 <= {latency.quantile(0.95) * 1000:.0f}ms, mean size {mean_size / 1024:.1f} KB")
+    for latency, tile, size in sorted(metrics.slowest, reverse=True)[:slowest]:
+        print(f"Slow tile {'/'.join(map(str, tile))}: {latency * 1000:.0f}ms, {size / 1024:.1f} KB")
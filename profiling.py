@@ -1,34 +1,86 @@
+import argparse
+import asyncio
+import csv
+import dataclasses
+import datetime
+import itertools
+import json
+import math
+import multiprocessing
+import queue
+import random
+import sys
+import threading
 import time
-from concurrent.futures import as_completed
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
 
 from requests_futures.sessions import FuturesSession
+import aiohttp
+import numpy as np
 import requests
+
+from benchmark_store import BenchmarkStore, add_compare_arguments, compare
+from latency_histogram import LatencyHistogram
+
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+try:
+    import h3
+except ImportError:
+    h3 = None
+
 requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
-def run_profiling():
-    import random
-    MIN_COORD = (43.70450356508819, -79.50834861469022)
-    MAX_COORD = (43.66585904620152, -79.31521611344768)
 
+# SERVER_URL = "https://map.henryn.xyz/api"
+SERVER_URL = "https://35.239.72.124"
+
+MIN_COORD = (43.70450356508819, -79.50834861469022)
+MAX_COORD = (43.66585904620152, -79.31521611344768)
+AGENCIES = ["TTC", "UP", "GO", "YRT", "BRAMPTON", "MIWAY", "GRT", "NYC-SUBWAY", "NYC-BUS", "NJ-BUS", "NJ-RAIL",
+            "VANCOUVER-TRANSLINK", "MONTREAL"]
+MODES = ["bus", "subway", "tram", "rail"]
+
+# City::get_city_center in src/agencies.rs
+CITY_CENTERS = {
+    "New York City": (40.7128, -74.0060),
+    "Vancouver": (49.2827, -123.1207),
+    "Toronto": (43.6532, -79.3832),
+    "Montreal": (45.5017, -73.5673),
+    "Paris": (48.8566, 2.3522),
+    "San Francisco": (37.7749, -122.4194),
+    "Chicago": (41.8781, -87.6298),
+    "London": (42.9849, -81.2453),
+}
 
-    # Generate a random number between min and max
-    def random_latlong():
-        return (random.uniform(MIN_COORD[0], MAX_COORD[0]),
-                random.uniform(MIN_COORD[1], MAX_COORD[1]))
 
+# Generate a random number between min and max
+def random_latlong(rng=random):
+    return (rng.uniform(MIN_COORD[0], MAX_COORD[0]),
+            rng.uniform(MIN_COORD[1], MAX_COORD[1]))
 
-    coords = [random_latlong() for _ in range(10000)]
+
+def hello_body(rng=random, origin: tuple | None = None) -> dict:
+    latitude, longitude = origin or random_latlong(rng)
+    return {"latitude": latitude, "longitude": longitude, "agencies": AGENCIES, "modes": MODES, "startTime": 47035,
+            "maxSearchTime": rng.uniform(2.0 * 3600, 2.20 * 3600)}
+
+
+def run_profiling(server_url: str = SERVER_URL, count: int = 10000):
+    # Closed loop: queues requests in batches and reports completed / elapsed only
+    coords = [hello_body() for _ in range(count)]
     t = time.time()
-    # SERVER_URL = "https://map.henryn.xyz/api/hello"
-    SERVER_URL = "https://35.239.72.124/hello"
     with FuturesSession() as session:
         futures = []
         completed = 0
-        for coord in coords:
-
-            search_time = random.uniform(2.0 * 3600, 2.20 * 3600)
-            data = {"latitude":coord[0],"longitude":coord[1],"agencies":["TTC","UP","GO","YRT","BRAMPTON","MIWAY","GRT","NYC-SUBWAY","NYC-BUS","NJ-BUS","NJ-RAIL","VANCOUVER-TRANSLINK","MONTREAL"],"modes":["bus","subway","tram","rail"],"startTime":47035,"maxSearchTime":search_time}
-
-            r = session.post(f'{SERVER_URL}', json=data, stream=True, verify=False)
+        for data in coords:
+            r = session.post(f'{server_url}/hello', json=data, stream=True, verify=False)
             futures.append(r)
 
             if len(futures) > 2000:
@@ -47,4 +99,1257 @@ def run_profiling():
         session.executor.shutdown(wait = True)
 
 
-run_profiling()
\ No newline at end of file
+def nearest_city(latitude: float, longitude: float) -> str:
+    scale = math.cos(math.radians(latitude))
+    return min(CITY_CENTERS, key=lambda city: (CITY_CENTERS[city][0] - latitude) ** 2
+                                              + ((CITY_CENTERS[city][1] - longitude) * scale) ** 2)
+
+
+def request_origin(body: dict | None) -> tuple | None:
+    # Where a request is about: /hello bodies carry the origin, /details a clicked point, /bike a start point
+    if not body:
+        return None
+    for point in (body, body.get("latlng"), body.get("start")):
+        if isinstance(point, dict) and "latitude" in point and "longitude" in point:
+            return point["latitude"], point["longitude"]
+    return None
+
+
+@dataclasses.dataclass
+class LoadRequest:
+    method: str
+    path: str
+    body: dict | None = None
+    tags: tuple = ()
+    # Called with the body of a 200 response, for workloads whose later requests depend on earlier responses
+    on_response: Callable[[bytes], None] | None = None
+
+
+def load_request(method: str, path: str, body: dict | None = None, tags: tuple = (),
+                 on_response: Callable[[bytes], None] | None = None) -> LoadRequest:
+    # Every request is reported under its endpoint, and under its city when it has a location
+    tags = (f"endpoint=/{path.lstrip('/').split('/')[0]}",) + tags
+    origin = request_origin(body)
+    if origin is not None:
+        tags += (f"city={nearest_city(*origin)}",)
+    return LoadRequest(method, path, body, tags, on_response)
+
+
+def lat_lon_to_tile(latitude: float, longitude: float, zoom: int) -> tuple:
+    n = 2 ** zoom
+    x = int((longitude + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2.0 * n)
+    return x, y
+
+
+def snap_to_grid(value: float, grid: float) -> float:
+    return round(round(value / grid) * grid, 10)
+
+
+class ResponseCacheModel:
+    # Client-side copy of the /hello response cache in src/web_cache.rs: an LRU of 30 keyed on the rounded origin,
+    # agencies, modes, start time, whole seconds of search time and transfer cost. Lookups happen when a request is
+    # sent and inserts when its response arrives, like the server. With several load processes each one only sees
+    # its own requests, so the prediction is only exact for a single process.
+
+    def __init__(self, size: int = 30):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(body: dict) -> tuple:
+        # `(x * 10000.0).round() as u64` saturates, so every negative coordinate rounds to 0
+        return (max(0, round(body["latitude"] * 10000)), max(0, round(body["longitude"] * 10000)),
+                tuple(body["agencies"]), tuple(body["modes"]), body["startTime"], int(body["maxSearchTime"]),
+                body.get("transferCostSecs") or 0)
+
+    def lookup(self, body: dict) -> bool:
+        key = self.key(body)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return True
+            return False
+
+    def insert(self, body: dict):
+        key = self.key(body)
+        with self.lock:
+            self.entries[key] = True
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class CacheLocality:
+    # Origins for a cache-friendly /hello workload: with probability repeat_ratio a request reuses one of
+    # `hot_count` earlier bodies, picked with Zipf(s) popularity, otherwise it is new. Origins can be snapped to a
+    # grid so nearby users share a cache key.
+
+    def __init__(self, rng: random.Random, repeat_ratio: float, hot_count: int = 200, zipf_s: float = 1.0,
+                 grid: float | None = None, cache_size: int = 30):
+        self.rng = rng
+        self.repeat_ratio = repeat_ratio
+        self.grid = grid
+        self.hot = []
+        self.hot_count = hot_count
+        self.cum_weights = list(itertools.accumulate(1 / rank ** zipf_s for rank in range(1, hot_count + 1)))
+        self.model = ResponseCacheModel(cache_size)
+
+    def choose(self, fresh: dict) -> dict:
+        if self.grid:
+            fresh["latitude"] = snap_to_grid(fresh["latitude"], self.grid)
+            fresh["longitude"] = snap_to_grid(fresh["longitude"], self.grid)
+        # The hot set fills up with the first new bodies, so early requests are all new
+        if len(self.hot) < self.hot_count:
+            self.hot.append(fresh)
+            return fresh
+        if self.rng.random() < self.repeat_ratio:
+            return self.rng.choices(self.hot, cum_weights=self.cum_weights)[0]
+        return fresh
+
+
+class Workload:
+    # Request generators for the endpoints the frontend calls. Generators run when their request is due, so
+    # /details can chain off the /hello responses received so far.
+
+    def __init__(self, rng: random.Random, cities: list | None = None, spread: float = 0.05,
+                 locality: CacheLocality | None = None):
+        self.rng = rng
+        # Without cities, origins come from the Toronto box run_profiling has always used
+        self.cities = cities
+        self.spread = spread
+        self.locality = locality
+        self.recent_hellos = deque(maxlen=20)
+        self.recent_origins = deque(maxlen=20)
+
+    def origin(self, center: tuple | None = None) -> tuple:
+        if center is None and self.cities is None:
+            return random_latlong(self.rng)
+        latitude, longitude = center or CITY_CENTERS[self.rng.choice(self.cities)]
+        return (latitude + self.rng.uniform(-self.spread, self.spread),
+                longitude + self.rng.uniform(-self.spread, self.spread))
+
+    def hello(self) -> LoadRequest:
+        request_body = hello_body(self.rng, self.origin())
+        tags = ()
+        if self.locality:
+            request_body = self.locality.choose(request_body)
+            tags = ("cache=hit" if self.locality.model.lookup(request_body) else "cache=miss",)
+        origin = request_body["latitude"], request_body["longitude"]
+        self.recent_origins.append(origin)
+
+        def remember(body: bytes):
+            self.recent_hellos.append((json.loads(body)["request_id"], origin))
+            if self.locality:
+                self.locality.model.insert(request_body)
+
+        return load_request("POST", "/hello", request_body, tags, remember)
+
+    def details(self) -> LoadRequest:
+        # A click near the origin of a recent /hello; the server only keeps recent request ids around
+        if not self.recent_hellos:
+            return self.hello()
+        request_id, (latitude, longitude) = self.rng.choice(self.recent_hellos)
+        latlng = {"latitude": latitude + self.rng.uniform(-0.02, 0.02),
+                  "longitude": longitude + self.rng.uniform(-0.02, 0.02)}
+        return load_request("POST", "/details", {"latlng": latlng, "request_id": request_id})
+
+    def mvt(self) -> LoadRequest:
+        # A tile under the map around a recent origin, at the zooms the map is usually viewed at
+        center = self.rng.choice(self.recent_origins) if self.recent_origins else None
+        latitude, longitude = self.origin(center)
+        zoom = self.rng.randint(10, 15)
+        x, y = lat_lon_to_tile(latitude, longitude, zoom)
+        return load_request("GET", f"/mvt/all_cities/{zoom}/{x}/{y}.bin",
+                            tags=(f"city={nearest_city(latitude, longitude)}",))
+
+    def bike(self) -> LoadRequest:
+        center = CITY_CENTERS[self.rng.choice(self.cities)] if self.cities else None
+        start = self.origin(center)
+        end = self.origin(center or start)
+        return load_request("POST", "/bike", {"start": {"latitude": start[0], "longitude": start[1]},
+                                              "end": {"latitude": end[0], "longitude": end[1]}})
+
+    def agencies(self) -> LoadRequest:
+        return load_request("GET", "/agencies")
+
+
+ENDPOINTS = ["hello", "details", "mvt", "bike", "agencies"]
+
+# Declarative mixes of endpoint weights, keyed by Workload generator. Custom mixes can be given as "hello=10,mvt=50"
+PROFILES = {
+    "hello": {"hello": 1},
+    # A user exploring the map: a few isochrones, many tiles, clicks on the result
+    "browse": {"hello": 10, "details": 25, "mvt": 55, "bike": 5, "agencies": 5},
+    "routing": {"hello": 40, "details": 30, "bike": 30},
+}
+
+
+def parse_profile(value: str) -> dict:
+    if value in PROFILES:
+        return PROFILES[value]
+    weights = {}
+    for part in value.split(","):
+        endpoint, _, weight = part.partition("=")
+        if endpoint not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"Unknown endpoint {endpoint!r}")
+        weights[endpoint] = float(weight or 1)
+    return weights
+
+
+def parse_cities(value: str) -> list:
+    cities = value.split(",")
+    for city in cities:
+        if city not in CITY_CENTERS:
+            raise argparse.ArgumentTypeError(f"Unknown city {city!r}")
+    return cities
+
+
+def arrival_times(rate: float, duration: float, poisson: bool, rng: random.Random):
+    # Intended send offsets: exponential gaps for Poisson arrivals, or evenly spaced. Even offsets are i / rate
+    # rather than a running sum, which drifts and sends one request too many.
+    if not poisson:
+        for i in range(math.ceil(rate * duration - 1e-9)):
+            yield i / rate
+        return
+    t = 0.0
+    while t < duration:
+        yield t
+        t += rng.expovariate(rate)
+
+
+def synthetic_schedule(rate: float, duration: float, poisson: bool, seed: int | None, profile: dict,
+                       cities: list | None = None, locality: dict | None = None):
+    rng = random.Random(seed)
+    workload = Workload(rng, cities, locality=CacheLocality(rng, **locality) if locality else None)
+    endpoints = list(profile)
+    weights = [profile[endpoint] for endpoint in endpoints]
+    for offset in arrival_times(rate, duration, poisson, rng):
+        yield offset, getattr(workload, rng.choices(endpoints, weights)[0])()
+
+
+def parse_timestamp(value) -> float:
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def replay_schedule(path: str, speed: float, asap: bool):
+    # Captured requests, one JSON object per line: {"timestamp": epoch seconds or ISO 8601, "endpoint": "/hello",
+    # "body": {...}}, with an optional "method" (POST when there is a body, GET otherwise). The offsets keep the
+    # original gaps divided by speed, or are None with asap, which sends each request as soon as a connection
+    # is free.
+    with open(path) as f:
+        captured = [json.loads(line) for line in f if line.strip()]
+    captured.sort(key=lambda entry: parse_timestamp(entry["timestamp"]))
+    first = parse_timestamp(captured[0]["timestamp"]) if captured else 0.0
+    for entry in captured:
+        body = entry.get("body")
+        method = entry.get("method", "POST" if body is not None else "GET")
+        offset = None if asap else (parse_timestamp(entry["timestamp"]) - first) / speed
+        yield offset, load_request(method, entry["endpoint"], body)
+
+
+# The server rejects maxSearchTime >= 3.5h
+MAX_SEARCH_TIME = 3.5 * 3600
+SWEEP_AXES = ["search_time", "agency_count", "modes", "start_time"]
+
+
+def sweep_cells(search_times: list, agency_counts: list, mode_sets: list, start_times: list) -> list:
+    return [{"search_time": search_time, "agency_count": agency_count, "modes": modes, "start_time": start_time}
+            for search_time, agency_count, modes, start_time
+            in itertools.product(search_times, agency_counts, mode_sets, start_times)]
+
+
+def sweep_schedule(cells: list, per_cell: int, rate: float, seed: int | None, cities: list | None):
+    # The cells' requests are shuffled together, so drift in server load over the run is spread over every cell
+    # instead of landing on whichever ran last. Origins are fresh, so the response cache stays out of the numbers.
+    rng = random.Random(seed)
+    workload = Workload(rng, cities)
+    order = [index for index in range(len(cells)) for _ in range(per_cell)]
+    rng.shuffle(order)
+    for i, index in enumerate(order):
+        cell = cells[index]
+        latitude, longitude = workload.origin()
+        body = {"latitude": latitude, "longitude": longitude, "agencies": AGENCIES[:cell["agency_count"]],
+                "modes": cell["modes"], "startTime": cell["start_time"], "maxSearchTime": cell["search_time"]}
+        yield i / rate, load_request("POST", "/hello", body, (f"sweep={index}",))
+
+
+def grid_cell(latitude: float, longitude: float, size: float) -> str:
+    return f"{math.floor(latitude / size)}:{math.floor(longitude / size)}"
+
+
+def grid_cell_boundary(cell: str, size: float) -> list:
+    row, column = (int(part) for part in cell.split(":"))
+    south, west, north, east = (round(value, 8) for value in (row * size, column * size, (row + 1) * size,
+                                                             (column + 1) * size))
+    return [(south, west), (south, east), (north, east), (north, west)]
+
+
+def heatmap_cell(latitude: float, longitude: float, args) -> str:
+    if args.h3_resolution is not None:
+        return h3.latlng_to_cell(latitude, longitude, args.h3_resolution)
+    return grid_cell(latitude, longitude, args.heatmap_cell)
+
+
+def with_heatmap_cells(schedule, args):
+    # Tags /hello requests with the cell of their origin, so each cell gets its own latency histogram and byte
+    # count that merge exactly across processes. Other endpoints don't depend much on where they are.
+    for offset, request in schedule:
+        if request.path == "/hello":
+            origin = request_origin(request.body)
+            request.tags += (f"cell={heatmap_cell(*origin, args)}",)
+        yield offset, request
+
+
+def build_schedule(args):
+    if args.mode == "replay":
+        schedule = replay_schedule(args.capture, args.speed, args.asap)
+    elif args.mode == "sweep":
+        schedule = sweep_schedule(args.cells, args.per_cell, args.rate, args.seed, args.cities)
+    else:
+        locality = None
+        if args.repeat_ratio is not None:
+            locality = {"repeat_ratio": args.repeat_ratio, "hot_count": args.hot_origins, "zipf_s": args.zipf,
+                        "grid": args.grid, "cache_size": args.cache_size}
+        schedule = synthetic_schedule(args.rate, args.duration, args.poisson, args.seed, args.profile, args.cities,
+                                      locality)
+    return with_heatmap_cells(schedule, args) if args.heatmap else schedule
+
+
+@dataclasses.dataclass
+class LoadResult:
+    histogram: LatencyHistogram = dataclasses.field(default_factory=LatencyHistogram)
+    ttfb: LatencyHistogram = dataclasses.field(default_factory=LatencyHistogram)
+    errors: Counter = dataclasses.field(default_factory=Counter)
+    tags: defaultdict = dataclasses.field(default_factory=lambda: defaultdict(LatencyHistogram))
+    tag_errors: Counter = dataclasses.field(default_factory=Counter)
+    tag_bytes: Counter = dataclasses.field(default_factory=Counter)
+    sent: int = 0
+    bytes: int = 0
+    send_elapsed: float = 0.0
+    elapsed: float = 0.0
+    max_send_lag: float = 0.0
+    cpu_seconds: float = 0.0
+    processes: int = 1
+    # Responses per second in each progress interval
+    throughput_samples: list = dataclasses.field(default_factory=list)
+
+    def record(self, latency: float, ttfb: float | None, status, size: int = 0, tags: tuple = ()):
+        # Latency is to the end of the body, ttfb to the response headers, both from the intended send time
+        self.histogram.record(latency)
+        if ttfb is not None:
+            self.ttfb.record(ttfb)
+        self.bytes += size
+        for tag in tags:
+            self.tags[tag].record(latency)
+            self.tag_bytes[tag] += size
+        if status != 200:
+            self.errors[str(status)] += 1
+            self.tag_errors.update(tags)
+
+    def merge(self, other: "LoadResult") -> "LoadResult":
+        # Exact: histogram buckets and counters add; the processes ran side by side, so durations take the max
+        self.histogram.merge(other.histogram)
+        self.ttfb.merge(other.ttfb)
+        self.errors.update(other.errors)
+        for tag, histogram in other.tags.items():
+            self.tags[tag].merge(histogram)
+        self.tag_errors.update(other.tag_errors)
+        self.tag_bytes.update(other.tag_bytes)
+        self.sent += other.sent
+        self.bytes += other.bytes
+        self.send_elapsed = max(self.send_elapsed, other.send_elapsed)
+        self.elapsed = max(self.elapsed, other.elapsed)
+        self.max_send_lag = max(self.max_send_lag, other.max_send_lag)
+        self.cpu_seconds += other.cpu_seconds
+        self.processes += other.processes
+        return self
+
+
+def run_schedule_threads(server_url: str, schedule, connections: int, timeout: float) -> LoadResult:
+    # Open loop: requests go out on the schedule whether or not earlier ones have finished, and latency is measured
+    # from the intended send time. A request that waits for a free worker is charged for the wait, so a stalled
+    # server shows up in the tail instead of silently lowering the request rate (coordinated omission).
+    result = LoadResult()
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(intended: float | None, request: LoadRequest):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        # Unpaced requests are timed from when a worker picks them up
+        intended = intended or time.perf_counter()
+        ttfb = None
+        size = 0
+        try:
+            # With stream=True, the call returns once the headers are in
+            resp = local.session.request(request.method, f"{server_url}{request.path}", json=request.body,
+                                         verify=False, timeout=timeout, stream=True)
+            ttfb = time.perf_counter() - intended
+            size = len(resp.content)
+            status = resp.status_code
+            if status == 200 and request.on_response:
+                request.on_response(resp.content)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        latency = time.perf_counter() - intended
+        with lock:
+            result.record(latency, ttfb, status, size, request.tags)
+
+    cpu = time.process_time()
+    start = time.perf_counter() + 0.1
+    time.sleep(0.1)
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        for offset, request in schedule:
+            intended = None
+            if offset is not None:
+                intended = start + offset
+                delay = intended - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                # How late the generator itself is; large values mean the client, not the server, is the bottleneck
+                result.max_send_lag = max(result.max_send_lag, -delay)
+            executor.submit(send, intended, request)
+            result.sent += 1
+        result.send_elapsed = time.perf_counter() - start
+    result.elapsed = time.perf_counter() - start
+    result.cpu_seconds = time.process_time() - cpu
+    return result
+
+
+async def fetch(session: aiohttp.ClientSession, server_url: str, request: LoadRequest, notify: bool = True) -> tuple:
+    # Returns (status, perf_counter time the headers arrived or None, body size)
+    headers_at = None
+    size = 0
+    try:
+        async with session.request(request.method, f"{server_url}{request.path}", json=request.body) as resp:
+            headers_at = time.perf_counter()
+            chunks = []
+            async for chunk in resp.content.iter_any():
+                size += len(chunk)
+                if request.on_response and notify:
+                    chunks.append(chunk)
+            status = resp.status
+        if status == 200 and request.on_response and notify:
+            request.on_response(b"".join(chunks))
+    except asyncio.TimeoutError:
+        status = "timeout"
+    except aiohttp.ClientError as e:
+        status = type(e).__name__
+    return status, headers_at, size
+
+
+def client_session(connections: int, timeout: float) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(limit=connections, ssl=False, keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout))
+
+
+async def run_schedule(server_url: str, schedule, connections: int, timeout: float, start_delay: float = 0.1,
+                       interval: float | None = None, on_interval=None) -> LoadResult:
+    # Same schedule as run_schedule_threads on one event loop, with a pool of keep-alive connections. Requests
+    # beyond `connections` wait in the connector's queue, and that wait is part of their latency. With `interval`,
+    # the requests finished in each interval are also handed to on_interval as a LoadResult of their own.
+    result = LoadResult()
+    window = LoadResult()
+    session = client_session(connections, timeout)
+    # Unpaced requests wait for one of these before being timed, so a backlog is not charged to the server
+    free_connections = asyncio.Semaphore(connections)
+
+    async def send(intended: float, request: LoadRequest, unpaced: bool):
+        try:
+            status, headers_at, size = await fetch(session, server_url, request)
+        finally:
+            if unpaced:
+                free_connections.release()
+        ttfb = headers_at - intended if headers_at else None
+        latency = time.perf_counter() - intended
+        result.record(latency, ttfb, status, size, request.tags)
+        window.record(latency, ttfb, status, size, request.tags)
+
+    def flush_window():
+        nonlocal window
+        finished, window = window, LoadResult()
+        finished.elapsed = time.perf_counter() - start
+        finished.cpu_seconds = time.process_time() - cpu
+        on_interval(finished)
+
+    async def report_intervals():
+        while True:
+            await asyncio.sleep(interval)
+            flush_window()
+
+    cpu = time.process_time()
+    start = time.perf_counter() + start_delay
+    tasks = set()
+    await asyncio.sleep(max(0.0, start - time.perf_counter()))
+    reporter = asyncio.create_task(report_intervals()) if interval else None
+    async with session:
+        for offset, request in schedule:
+            if offset is None:
+                await free_connections.acquire()
+                intended = time.perf_counter()
+            else:
+                intended = start + offset
+                delay = intended - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                result.max_send_lag = max(result.max_send_lag, -delay)
+            task = asyncio.create_task(send(intended, request, offset is None))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            result.sent += 1
+            window.sent += 1
+        result.send_elapsed = time.perf_counter() - start
+        await asyncio.gather(*tasks)
+    result.elapsed = time.perf_counter() - start
+    result.cpu_seconds = time.process_time() - cpu
+    if reporter is not None:
+        reporter.cancel()
+        if window.sent or window.histogram.count:
+            flush_window()
+    return result
+
+
+def until_stopped(schedule, stop):
+    # Ends the schedule early once `stop` (a threading or multiprocessing Event) is set
+    for item in schedule:
+        if stop.is_set():
+            return
+        yield item
+
+
+def with_shared_seed(args):
+    # Every process must build the same schedule to take its share of it, so an unseeded run gets one seed for all
+    if getattr(args, "seed", 0) is not None:
+        return args
+    args = argparse.Namespace(**vars(args))
+    args.seed = random.randrange(2 ** 32)
+    return args
+
+
+def worker_schedule(args, index: int):
+    # Every Nth request of the schedule, so the processes' shares add up to a single-process run
+    return itertools.islice(build_schedule(args), index, None, args.processes)
+
+
+def load_worker(index: int, args, start_time: float, results: multiprocessing.Queue, stop):
+    # One process of a multi-process run. It sends its interval windows and then its final result.
+    schedule = until_stopped(worker_schedule(args, index), stop)
+    result = asyncio.run(run_schedule(
+        args.server, schedule, args.connections, args.timeout, start_time - time.time(), args.interval,
+        lambda window: results.put(("interval", index, window))))
+    results.put(("done", index, result))
+
+
+def run_processes(args, stop_when=None) -> LoadResult:
+    # Each process runs its own event loop with its share of the schedule. Windows from all processes are merged
+    # and printed every interval; the final result is the exact merge of the processes' histograms and counters.
+    args = with_shared_seed(args)
+    results = multiprocessing.Queue()
+    start_time = time.time() + 1.0
+    progress = Progress(args.interval, stop_when, multiprocessing.Event())
+    workers = [multiprocessing.Process(target=load_worker, args=(index, args, start_time, results, progress.stop))
+               for index in range(args.processes)]
+    for worker in workers:
+        worker.start()
+
+    total = None
+    # Every process flushes a window each interval from the shared start time; the n-th windows of all processes are
+    # merged and shown together once each process still running has sent its n-th
+    windows = defaultdict(lambda: LoadResult(processes=0))
+    sent_windows = [0] * args.processes
+    finished = [False] * args.processes
+    next_window = 0
+    while not all(finished):
+        try:
+            kind, index, result = results.get(timeout=1.0)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                raise RuntimeError("Load worker processes exited without reporting")
+            continue
+        if kind == "done":
+            total = result if total is None else total.merge(result)
+            finished[index] = True
+        else:
+            windows[sent_windows[index]].merge(result)
+            sent_windows[index] += 1
+        while next_window in windows and all(finished[index] or sent_windows[index] > next_window
+                                             for index in range(args.processes)):
+            window = windows.pop(next_window)
+            progress(window, window.elapsed)
+            next_window += 1
+
+    for worker in workers:
+        worker.join()
+    total.throughput_samples = progress.samples
+    return total
+
+
+def run_load(args, stop_when=None) -> LoadResult:
+    # stop_when(window, seconds) is called with each progress window and ends the run early by returning True
+    if args.processes > 1:
+        return run_processes(args, stop_when)
+    if args.backend == "threads":
+        return run_schedule_threads(args.server, build_schedule(args), args.connections, args.timeout)
+    progress = Progress(args.interval, stop_when)
+    result = asyncio.run(run_schedule(
+        args.server, until_stopped(build_schedule(args), progress.stop), args.connections, args.timeout,
+        interval=args.interval,
+        on_interval=lambda window: progress(window, window.elapsed)))
+    result.throughput_samples = progress.samples
+    return result
+
+
+async def run_ab(server_a: str, server_b: str, schedule, connections: int, timeout: float, seed: int | None) -> dict:
+    # Every request goes to both servers back to back, in a random order per pair so neither side always gets the
+    # warmer caches or the quieter moment. Pairs start on the schedule; within a pair each latency is measured from
+    # its own send, so the two sides see the same load and the same machine noise. An A/A check against a single
+    # server needs its response cache off, or the second send of every pair is a hit.
+    rng = random.Random(seed)
+    results = {"A": LoadResult(), "B": LoadResult()}
+    pairs = []
+    a_first = 0
+    session = client_session(connections, timeout)
+
+    async def send_pair(request: LoadRequest, order: list):
+        latencies = {}
+        for side, server_url in order:
+            sent = time.perf_counter()
+            # Only A's responses feed the workload, so chained requests stay consistent between runs
+            status, headers_at, size = await fetch(session, server_url, request, notify=side == "A")
+            latency = time.perf_counter() - sent
+            results[side].record(latency, headers_at - sent if headers_at else None, status, size, request.tags)
+            latencies[side] = latency if status == 200 else None
+        if latencies["A"] and latencies["B"]:
+            pairs.append((latencies["A"], latencies["B"]))
+
+    start = time.perf_counter() + 0.1
+    tasks = set()
+    async with session:
+        for offset, request in schedule:
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            order = [("A", server_a), ("B", server_b)]
+            if rng.random() < 0.5:
+                order.reverse()
+            else:
+                a_first += 1
+            task = asyncio.create_task(send_pair(request, order))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            results["A"].sent += 1
+            results["B"].sent += 1
+        await asyncio.gather(*tasks)
+    for result in results.values():
+        result.elapsed = result.send_elapsed = time.perf_counter() - start
+    return {"results": results, "pairs": pairs, "a_first": a_first}
+
+
+def signed_rank_test(differences: np.ndarray) -> float:
+    # Two-sided Wilcoxon signed-rank p-value, normal approximation with tie correction (fine past ~20 pairs)
+    differences = differences[differences != 0]
+    n = len(differences)
+    if n == 0:
+        return 1.0
+    magnitudes = np.abs(differences)
+    order = np.argsort(magnitudes)
+    ranks = np.empty(n)
+    ranks[order] = np.arange(1, n + 1)
+    _, inverse, counts = np.unique(magnitudes, return_inverse=True, return_counts=True)
+    # Tied magnitudes share their average rank
+    ranks = (np.bincount(inverse, weights=ranks) / counts)[inverse]
+    positive = ranks[differences > 0].sum()
+    mean = n * (n + 1) / 4
+    variance = n * (n + 1) * (2 * n + 1) / 24 - (counts ** 3 - counts).sum() / 48
+    if variance <= 0:
+        return 1.0
+    z = (positive - mean) / math.sqrt(variance)
+    return math.erfc(abs(z) / math.sqrt(2))
+
+
+def paired_stats(pairs: list, confidence: float = 0.95, seed: int = 0) -> dict:
+    # Ratios are B / A per request. Their geometric mean is the typical relative change; its interval is a
+    # bootstrap over pairs, and the signed-rank test asks whether B is systematically faster or slower than A
+    a, b = np.array(pairs).T
+    log_ratios = np.log(b / a)
+    rng = np.random.default_rng(seed)
+    means = rng.choice(log_ratios, size=(2000, len(log_ratios))).mean(axis=1)
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.exp(np.percentile(means, [tail, 100 - tail]))
+    return {
+        "pairs": len(pairs),
+        "geometric_mean": float(np.exp(log_ratios.mean())),
+        "ci": (float(low), float(high)),
+        "percentiles": {p: float(np.exp(np.percentile(log_ratios, p))) for p in (1, 10, 25, 50, 75, 90, 99)},
+        "b_slower": float((log_ratios > 0).mean()),
+        "p_value": signed_rank_test(log_ratios),
+    }
+
+
+def print_ab(ab: dict, server_a: str, server_b: str, alpha: float = 0.05):
+    for side, server_url in (("A", server_a), ("B", server_b)):
+        result = ab["results"][side]
+        summary = result.histogram.summary()
+        errors = sum(result.errors.values())
+        print(f"{side} {server_url}: " + ", ".join(f"{name} {summary[name] * 1000:.1f}ms"
+                                                  for name in ("p50", "p90", "p99", "max")) + f", {errors} errors")
+    if len(ab["pairs"]) < 2:
+        print("Not enough successful pairs to compare")
+        return
+    stats = paired_stats(ab["pairs"])
+    print(f"{stats['pairs']} paired requests, A sent first in {ab['a_first']}")
+    print("B / A latency ratio percentiles: " + ", ".join(f"p{p} {ratio:.3f}"
+                                                         for p, ratio in stats["percentiles"].items()))
+    low, high = stats["ci"]
+    print(f"Geometric mean ratio {stats['geometric_mean']:.3f} (95% CI {low:.3f} to {high:.3f}), B slower in "
+          f"{100 * stats['b_slower']:.0f}% of pairs, signed-rank p = {stats['p_value']:.2g}")
+    change = 100 * (stats["geometric_mean"] - 1)
+    if stats["p_value"] < alpha:
+        print(f"B is {abs(change):.1f}% {'slower' if change > 0 else 'faster'} than A (significant at {alpha})")
+    else:
+        print(f"No significant difference at {alpha}")
+
+
+class StepMonitor:
+    # Decides when a capacity step has settled. The first window is warm-up. After it, the step fails as soon as a
+    # window has errors or breaks the SLO, and ends once the p99s of the last `windows` windows agree within
+    # `stability`.
+
+    def __init__(self, slo: float, stability: float, windows: int = 3):
+        self.slo = slo
+        self.stability = stability
+        self.needed = windows
+        self.warmed_up = False
+        self.windows = []
+        self.done = False
+        self.stable = False
+        self.failed = False
+
+    def __call__(self, window: LoadResult, seconds: float) -> bool:
+        # Windows still arriving after the decision hold the requests in flight when it was made
+        if self.done:
+            return True
+        if not self.warmed_up:
+            self.warmed_up = True
+            return False
+        self.windows.append((window, seconds))
+        if window.errors or window.histogram.count == 0 or window.histogram.percentile(99) > self.slo:
+            self.done = self.failed = True
+        elif len(self.windows) >= self.needed:
+            recent = [window.histogram.percentile(99) for window, _ in self.windows[-self.needed:]]
+            self.done = self.stable = max(recent) - min(recent) <= self.stability * max(recent)
+        return self.done
+
+    def measured(self) -> LoadResult:
+        result = LoadResult(processes=0)
+        for window, seconds in self.windows:
+            result.merge(window)
+            result.throughput_samples.append((window.histogram.count - sum(window.errors.values())) / seconds)
+        result.elapsed = result.send_elapsed = sum(seconds for _, seconds in self.windows)
+        return result
+
+
+def run_capacity_step(args, rate: float) -> tuple:
+    # Open-loop load at `rate` for up to --max-hold seconds, stopped early by a StepMonitor. Returns the curve row
+    # and the measured windows as a LoadResult.
+    print(f"Step at {rate:.1f}/s")
+    step_args = argparse.Namespace(**vars(args))
+    step_args.rate = rate
+    step_args.duration = args.max_hold
+    monitor = StepMonitor(args.slo_p99_ms / 1000, args.stability)
+    run_load(step_args, monitor)
+    measured = monitor.measured()
+    histogram = measured.histogram
+    errors = sum(measured.errors.values())
+    throughput = (histogram.count - errors) / max(measured.elapsed, 1e-9)
+    row = {
+        "rate": round(rate, 1),
+        "throughput": round(throughput, 1),
+        "p50_ms": round(histogram.percentile(50) * 1000, 3),
+        "p90_ms": round(histogram.percentile(90) * 1000, 3),
+        "p99_ms": round(histogram.percentile(99) * 1000, 3),
+        "errors": errors,
+        "seconds": round(measured.elapsed, 1),
+        "stable": monitor.stable,
+        # A p99 still moving at --max-hold says nothing about the rate being sustainable. An open-loop client that
+        # gets fewer responses than it sends is building a queue somewhere.
+        "passed": (monitor.stable and not monitor.failed and histogram.count > 0 and errors == 0
+                   and histogram.percentile(99) <= args.slo_p99_ms / 1000
+                   and throughput >= args.min_throughput_ratio * rate),
+    }
+    print(f"  {row['throughput']:.1f}/s, p50 {row['p50_ms']:.1f}ms, p99 {row['p99_ms']:.1f}ms, {errors} errors"
+          f"{'' if monitor.stable else ', not stable'}: {'pass' if row['passed'] else 'FAIL'}")
+    return row, measured
+
+
+def capacity_search(args) -> tuple:
+    # Ramps the rate up from --start-rate until a step fails the SLO. The binary search then bisects between the
+    # last passing and the first failing rate down to --precision. Returns the curve rows by rate and the measured
+    # result of the highest passing step.
+    steps = {}
+
+    def step(rate: float) -> bool:
+        steps[rate] = run_capacity_step(args, rate)
+        if args.cooldown:
+            time.sleep(args.cooldown)
+        return steps[rate][0]["passed"]
+
+    passed = failed = None
+    rate = args.start_rate
+    while rate <= args.max_rate:
+        if not step(rate):
+            failed = rate
+            break
+        passed = rate
+        rate = rate + args.step if args.step else rate * args.step_factor
+    if args.search == "binary" and passed is not None and failed is not None:
+        while failed / passed > 1 + args.precision:
+            middle = (passed + failed) / 2
+            if step(middle):
+                passed = middle
+            else:
+                failed = middle
+    rows = [steps[rate][0] for rate in sorted(steps)]
+    return rows, steps[passed][1] if passed is not None else None, failed
+
+
+def knee_point(rows: list) -> dict | None:
+    # Kneedle: with the offered rate and p99 both scaled to [0, 1], the knee is the step furthest below the line
+    # from the first step to the last, where latency turns from flat to steep
+    if len(rows) < 3:
+        return None
+    rates = np.array([row["rate"] for row in rows])
+    p99s = np.array([row["p99_ms"] for row in rows])
+    if p99s.max() == p99s.min():
+        return None
+    x = (rates - rates.min()) / (rates.max() - rates.min())
+    y = (p99s - p99s.min()) / (p99s.max() - p99s.min())
+    return rows[int(np.argmax(x - y))]
+
+
+class Progress:
+    # Prints a line per interval window and keeps each full window's response rate as a throughput sample. Sets
+    # `stop` once stop_when(window, seconds) returns True.
+
+    def __init__(self, interval: float, stop_when=None, stop=None):
+        self.interval = interval
+        self.stop_when = stop_when
+        self.stop = stop if stop is not None else threading.Event()
+        self.running = LoadResult(processes=0)
+        self.last = 0.0
+        self.samples = []
+
+    def __call__(self, window: LoadResult, elapsed: float):
+        self.running.merge(window)
+        duration, self.last = elapsed - self.last, elapsed
+        # The last window of a run is usually partial
+        if duration >= self.interval / 2:
+            self.samples.append(window.histogram.count / duration)
+        print_interval(window, self.running, elapsed)
+        if self.stop_when is not None and not self.stop.is_set() and self.stop_when(window, duration):
+            self.stop.set()
+
+
+def save_result(args, result: LoadResult):
+    if args.no_save:
+        return
+    config = {key: value for key, value in vars(args).items()
+              if key not in ("no_save", "results", "save_baseline", "compare", "max_p99_increase",
+                             "max_throughput_decrease", "interval", "output")}
+    store = BenchmarkStore(args.results)
+    run_id = store.save(args.mode, config, result)
+    print(f"Saved as run {run_id} in {args.results}")
+    if args.save_baseline:
+        store.set_baseline(args.save_baseline, run_id)
+        print(f"Baseline {args.save_baseline!r} is run {run_id}")
+    regressed = False
+    if args.compare:
+        regressed = compare(store, args.compare, run_id, args.max_p99_increase, args.max_throughput_decrease)
+    store.close()
+    if regressed:
+        sys.exit(1)
+
+
+def print_interval(window: LoadResult, running: LoadResult, elapsed: float):
+    summary = window.histogram.summary()
+    print(f"[{elapsed:5.0f}s] {window.histogram.count} responses, p50 {summary['p50'] * 1000:.1f}ms, "
+          f"p99 {summary['p99'] * 1000:.1f}ms, {sum(window.errors.values())} errors; "
+          f"overall p99 {running.histogram.percentile(99) * 1000:.1f}ms")
+
+
+def print_tags(result: LoadResult):
+    # One table per tag kind (endpoint, city, ...) that has more than one value
+    kinds = defaultdict(list)
+    for tag in result.tags:
+        kind, _, value = tag.partition("=")
+        kinds[kind].append(value)
+    # Sweep and heatmap cells are reported by write_sweep and write_heatmap
+    for kind in sorted(kind for kind in kinds if len(kinds[kind]) > 1 and kind not in ("sweep", "cell")):
+        print(f"{'By ' + kind:<24} {'count':>8} {'errors':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'p99.9':>9}")
+        for value in sorted(kinds[kind], key=lambda value: -result.tags[f"{kind}={value}"].count):
+            histogram = result.tags[f"{kind}={value}"]
+            print(f"  {value:<22} {histogram.count:>8} {result.tag_errors[f'{kind}={value}']:>7} "
+                  + " ".join(f"{histogram.percentile(p) * 1000:>7.1f}ms" for p in (50, 90, 99, 99.9)))
+
+
+def print_report(result: LoadResult, rate: float | None = None):
+    errors = sum(result.errors.values())
+    target = f" (target {rate:.1f}/s)" if rate else ""
+    print(f"{result.sent} requests sent at {result.sent / max(result.send_elapsed, 1e-9):.1f}/s{target}, "
+          f"finished in {result.elapsed:.1f}s, {errors} errors ({100 * errors / max(result.sent, 1):.2f}%)")
+    if result.errors:
+        print("Errors:", ", ".join(f"{status}: {count}" for status, count in result.errors.most_common()))
+    for label, histogram in (("Latency", result.histogram), ("TTFB", result.ttfb)):
+        summary = histogram.summary()
+        print(f"{label}: " + ", ".join(f"{name} {summary[name] * 1000:.1f}ms"
+                                       for name in ("p50", "p90", "p99", "p99.9", "max")))
+    print_tags(result)
+    # A Python client process tops out around one core; past that the numbers describe the client, not the server
+    cores = result.cpu_seconds / max(result.elapsed, 1e-9) / result.processes
+    print(f"{result.bytes / 1e6:.1f} MB received. Client CPU: {result.cpu_seconds:.1f}s over {result.processes} "
+          f"process(es), {100 * cores:.0f}% of a core each")
+    if cores > 0.8 or result.max_send_lag > 0.01:
+        print(f"Warning: the client may be limiting the rate (sends up to {result.max_send_lag * 1000:.0f}ms behind "
+              f"schedule, {100 * cores:.0f}% CPU per process)")
+
+
+def cell_label(axis: str, value) -> str:
+    return "+".join(value) if axis == "modes" else f"{value:g}"
+
+
+def sweep_rows(result: LoadResult, cells: list, axes: list) -> list:
+    # One row per distinct combination of `axes`, merging the histograms of the cells it covers
+    groups = {}
+    for index, cell in enumerate(cells):
+        key = tuple(cell_label(axis, cell[axis]) for axis in axes)
+        row = groups.setdefault(key, {"histogram": LatencyHistogram(), "errors": 0, "bytes": 0})
+        tag = f"sweep={index}"
+        row["histogram"].merge(result.tags.get(tag, LatencyHistogram()))
+        row["errors"] += result.tag_errors[tag]
+        row["bytes"] += result.tag_bytes[tag]
+
+    rows = []
+    for key, group in groups.items():
+        histogram = group["histogram"]
+        summary = histogram.summary()
+        rows.append(dict(zip(axes, key)) | {
+            "count": histogram.count,
+            "errors": group["errors"],
+            "p50_ms": round(summary["p50"] * 1000, 3),
+            "p90_ms": round(summary["p90"] * 1000, 3),
+            "p99_ms": round(summary["p99"] * 1000, 3),
+            "mean_ms": round(summary["mean"] * 1000, 3),
+            "mean_kb": round(group["bytes"] / max(histogram.count, 1) / 1024, 3),
+        })
+    return rows
+
+
+def write_sweep(result: LoadResult, cells: list, output: str):
+    rows = sweep_rows(result, cells, SWEEP_AXES)
+    with open(f"{output}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Wrote {len(rows)} cells to {output}.csv")
+
+    # Per axis, every other parameter is merged in, giving one latency and size curve per parameter
+    for axis in SWEEP_AXES:
+        axis_rows = sweep_rows(result, cells, [axis])
+        print(f"{'By ' + axis:<24} {'count':>7} {'errors':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'size':>9}")
+        for row in axis_rows:
+            print(f"  {row[axis]:<22} {row['count']:>7} {row['errors']:>7} {row['p50_ms']:>7.1f}ms "
+                  f"{row['p90_ms']:>7.1f}ms {row['p99_ms']:>7.1f}ms {row['mean_kb']:>7.1f}KB")
+        if plt is None:
+            continue
+        labels = [row[axis] for row in axis_rows]
+        figure, (latency, size) = plt.subplots(2, 1, sharex=True, figsize=(8, 7))
+        for name in ("p50_ms", "p90_ms", "p99_ms"):
+            latency.plot(labels, [row[name] for row in axis_rows], marker="o", label=name[:-3])
+        latency.set_ylabel("Latency (ms)")
+        latency.legend()
+        size.plot(labels, [row["mean_kb"] for row in axis_rows], marker="o")
+        size.set_ylabel("Mean response (KB)")
+        size.set_xlabel(axis)
+        figure.suptitle(f"/hello latency and response size by {axis}")
+        figure.savefig(f"{output}_{axis}.png", dpi=120)
+        plt.close(figure)
+    if plt is None:
+        print("matplotlib is not installed, skipping plots")
+    else:
+        print(f"Wrote plots to {output}_<axis>.png")
+
+
+def write_heatmap(result: LoadResult, args, slowest: int = 10):
+    # One GeoJSON polygon and CSV row per cell with /hello latency percentiles and mean response size
+    rows = []
+    features = []
+    for tag, histogram in result.tags.items():
+        if not tag.startswith("cell="):
+            continue
+        cell = tag[len("cell="):]
+        if args.h3_resolution is not None:
+            boundary = list(h3.cell_to_boundary(cell))
+        else:
+            boundary = grid_cell_boundary(cell, args.heatmap_cell)
+        summary = histogram.summary()
+        row = {
+            "cell": cell,
+            "latitude": round(sum(point[0] for point in boundary) / len(boundary), 6),
+            "longitude": round(sum(point[1] for point in boundary) / len(boundary), 6),
+            "count": histogram.count,
+            "errors": result.tag_errors[tag],
+            "p50_ms": round(summary["p50"] * 1000, 3),
+            "p90_ms": round(summary["p90"] * 1000, 3),
+            "p99_ms": round(summary["p99"] * 1000, 3),
+            "mean_ms": round(summary["mean"] * 1000, 3),
+            "mean_kb": round(result.tag_bytes[tag] / max(histogram.count, 1) / 1024, 3),
+        }
+        rows.append(row)
+        ring = [[longitude, latitude] for latitude, longitude in boundary]
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [ring + ring[:1]]},
+            "properties": row,
+        })
+    if not rows:
+        print("No /hello requests to map")
+        return
+
+    rows.sort(key=lambda row: row["cell"])
+    with open(f"{args.heatmap}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(f"{args.heatmap}.geojson", "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    print(f"Wrote {len(rows)} cells to {args.heatmap}.geojson and {args.heatmap}.csv")
+
+    # Cells with a handful of requests have meaningless percentiles
+    ranked = sorted((row for row in rows if row["count"] >= 5), key=lambda row: -row["p90_ms"])
+    for row in ranked[:slowest]:
+        print(f"Slow cell {row['cell']} around {row['latitude']:.4f},{row['longitude']:.4f}: {row['count']} requests, "
+              f"p50 {row['p50_ms']:.1f}ms, p90 {row['p90_ms']:.1f}ms, {row['mean_kb']:.1f} KB")
+
+
+def write_capacity(rows: list, knee: dict | None, slo_ms: float, output: str):
+    with open(f"{output}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Wrote {len(rows)} steps to {output}.csv")
+    if plt is None:
+        print("matplotlib is not installed, skipping the plot")
+        return
+    figure, axes = plt.subplots(figsize=(8, 5))
+    throughputs = [row["throughput"] for row in rows]
+    for name in ("p50_ms", "p90_ms", "p99_ms"):
+        axes.plot(throughputs, [row[name] for row in rows], marker="o", label=name[:-3])
+    axes.axhline(slo_ms, color="red", linestyle="--", label="p99 SLO")
+    if knee is not None:
+        axes.plot(knee["throughput"], knee["p99_ms"], marker="x", markersize=12, color="black",
+                  label=f"knee at {knee['rate']:g}/s")
+    axes.set_xlabel("Throughput (responses/s)")
+    axes.set_ylabel("Latency (ms)")
+    axes.set_yscale("log")
+    axes.legend()
+    figure.suptitle("Latency against throughput")
+    figure.savefig(f"{output}.png", dpi=120)
+    plt.close(figure)
+    print(f"Wrote the curve to {output}.png")
+
+
+def positive_float(value: str) -> float:
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+
+def parse_list(value_type):
+    return lambda value: [value_type(part) for part in value.split(",")]
+
+
+def parse_search_times(value: str) -> list:
+    search_times = parse_list(float)(value)
+    if max(search_times) >= MAX_SEARCH_TIME:
+        raise argparse.ArgumentTypeError(f"Search times must be under {MAX_SEARCH_TIME:.0f}s")
+    return search_times
+
+
+def add_load_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--backend", choices=["async", "threads"], default="async",
+                        help="aiohttp on one event loop, or a requests thread pool")
+    parser.add_argument("--connections", type=int, default=256, help="Maximum requests in flight per process")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Event loop processes sharing the schedule (async backend only)")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between progress lines")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--results", default="benchmarks.sqlite", help="SQLite store the run is saved to")
+    parser.add_argument("--no-save", action="store_true", help="Don't save the run")
+    parser.add_argument("--save-baseline", metavar="NAME", help="Also name the run as a baseline")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="Compare the run with a named baseline and exit 1 if it regressed")
+    add_compare_arguments(parser)
+    parser.add_argument("--heatmap", metavar="PREFIX",
+                        help="Write /hello latency and size per origin cell to PREFIX.geojson and PREFIX.csv")
+    parser.add_argument("--heatmap-cell", type=float, default=0.01, help="Heatmap grid cell size in degrees")
+    parser.add_argument("--h3-resolution", type=int, help="Use H3 cells of this resolution instead of the grid "
+                                                          "(needs the h3 package)")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Load test the time2reach server")
+    parser.add_argument("--server", default=SERVER_URL)
+    subparsers = parser.add_subparsers(dest="mode")
+
+    closed = subparsers.add_parser("closed", help="Batches of back-to-back /hello requests, reporting throughput only")
+    closed.add_argument("--count", type=int, default=10000)
+
+    open_loop = subparsers.add_parser("open", help="Requests at a fixed arrival rate, reporting the latency "
+                                                   "distribution")
+    open_loop.add_argument("--rate", type=float, required=True, help="Requests per second")
+    open_loop.add_argument("--duration", type=float, default=30.0, help="Seconds")
+    open_loop.add_argument("--poisson", action="store_true", help="Exponential gaps between requests")
+    open_loop.add_argument("--seed", type=int)
+    open_loop.add_argument("--profile", type=parse_profile, default="hello",
+                           help=f"Endpoint mix: one of {', '.join(PROFILES)}, or weights like hello=10,mvt=50")
+    open_loop.add_argument("--cities", type=parse_cities,
+                           help=f"Comma-separated origins from: {', '.join(CITY_CENTERS)}. Default is central Toronto")
+    open_loop.add_argument("--repeat-ratio", type=float,
+                           help="Fraction of /hello requests that repeat a popular earlier one. Enables reporting "
+                                "latency for predicted response cache hits and misses (exact with one process)")
+    open_loop.add_argument("--hot-origins", type=int, default=200, help="Number of popular /hello requests")
+    open_loop.add_argument("--zipf", type=float, default=1.0, help="Zipf exponent of their popularity")
+    open_loop.add_argument("--grid", type=float, help="Snap origins to a grid of this many degrees, e.g. 0.0001")
+    open_loop.add_argument("--cache-size", type=int, default=30, help="Entries in the server's response cache")
+    add_load_arguments(open_loop)
+
+    replay = subparsers.add_parser("replay", help="Replay captured requests, reporting latency per endpoint and city")
+    replay.add_argument("capture", help="JSONL of captured requests with timestamp, endpoint and body")
+    replay.add_argument("--speed", type=positive_float, default=1.0, help="Playback speed, 2 replays twice as fast")
+    replay.add_argument("--asap", action="store_true", help="Ignore the timestamps and send as fast as connections "
+                                                            "allow")
+    add_load_arguments(replay)
+
+    ab = subparsers.add_parser("ab", help="Send the same requests to --server (A) and --server-b (B) in interleaved "
+                                          "order and compare paired latencies")
+    ab.add_argument("--server-b", required=True)
+    ab.add_argument("--rate", type=float, default=20.0, help="Request pairs per second")
+    ab.add_argument("--duration", type=float, default=60.0, help="Seconds")
+    ab.add_argument("--seed", type=int)
+    ab.add_argument("--profile", type=parse_profile, default="hello",
+                    help=f"Endpoint mix: one of {', '.join(PROFILES)}, or weights like hello=10,mvt=50. /details is "
+                         f"not supported, request ids differ between servers")
+    ab.add_argument("--cities", type=parse_cities,
+                    help=f"Comma-separated origins from: {', '.join(CITY_CENTERS)}. Default is central Toronto")
+    ab.add_argument("--connections", type=int, default=64, help="Maximum pairs in flight")
+    ab.add_argument("--timeout", type=float, default=60.0)
+    ab.add_argument("--alpha", type=float, default=0.05, help="Significance level")
+
+    sweep = subparsers.add_parser("sweep", help="/hello latency and response size over a grid of request parameters")
+    sweep.add_argument("--search-times", type=parse_search_times, default="1800,3600,5400,7200,9000,10800,12000",
+                       help="maxSearchTime values in seconds")
+    sweep.add_argument("--agency-counts", type=parse_list(int), default="1,4,7,13",
+                       help=f"Number of agencies sent, taken in order from {', '.join(AGENCIES)}")
+    sweep.add_argument("--mode-sets", type=lambda value: [modes.split(",") for modes in value.split(";")],
+                       default="bus;bus,subway;bus,subway,tram,rail", help="Semicolon-separated mode lists")
+    sweep.add_argument("--start-times", type=parse_list(int), default="25200,47035,64800,82800",
+                       help="startTime values in seconds after midnight")
+    sweep.add_argument("--per-cell", type=int, default=20, help="Requests per parameter combination")
+    sweep.add_argument("--rate", type=float, default=20.0, help="Requests per second, low enough not to queue")
+    sweep.add_argument("--seed", type=int)
+    sweep.add_argument("--cities", type=parse_cities,
+                       help=f"Comma-separated origins from: {', '.join(CITY_CENTERS)}. Default is central Toronto")
+    sweep.add_argument("--output", default="sweep", help="Prefix for the CSV table and PNG plots")
+    add_load_arguments(sweep)
+
+    capacity = subparsers.add_parser("capacity", help="Ramp the request rate to find the highest one whose p99 "
+                                                      "stays under an SLO without errors")
+    capacity.add_argument("--slo-p99-ms", type=float, required=True, help="p99 latency objective in milliseconds")
+    capacity.add_argument("--search", choices=["step", "binary"], default="binary",
+                          help="Stop at the first failing step, or bisect between it and the last passing one")
+    capacity.add_argument("--start-rate", type=float, default=10.0, help="Requests per second of the first step")
+    capacity.add_argument("--max-rate", type=float, default=5000.0)
+    capacity.add_argument("--step-factor", type=float, default=1.5, help="Rate multiplier between steps")
+    capacity.add_argument("--step", type=float, help="Add this many requests per second per step instead")
+    capacity.add_argument("--precision", type=float, default=0.05,
+                          help="Relative gap between passing and failing rates where the binary search stops")
+    capacity.add_argument("--max-hold", type=float, default=60.0,
+                          help="Longest a step runs waiting for its p99 to stabilise, in seconds. A step that "
+                               "doesn't stabilise fails")
+    capacity.add_argument("--stability", type=float, default=0.1,
+                          help="Relative p99 spread over three --interval windows that counts as stable")
+    capacity.add_argument("--min-throughput-ratio", type=float, default=0.9,
+                          help="Fraction of the offered rate a passing step must answer")
+    capacity.add_argument("--cooldown", type=float, default=5.0, help="Seconds between steps")
+    capacity.add_argument("--poisson", action="store_true", help="Exponential gaps between requests")
+    capacity.add_argument("--seed", type=int)
+    capacity.add_argument("--profile", type=parse_profile, default="hello",
+                          help=f"Endpoint mix: one of {', '.join(PROFILES)}, or weights like hello=10,mvt=50")
+    capacity.add_argument("--cities", type=parse_cities,
+                          help=f"Comma-separated origins from: {', '.join(CITY_CENTERS)}. Default is central Toronto")
+    capacity.add_argument("--output", default="capacity", help="Prefix for the CSV curve and PNG plot")
+    capacity.set_defaults(repeat_ratio=None)
+    add_load_arguments(capacity)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.mode in ("open", "replay", "sweep", "capacity"):
+        if args.processes > 1 and args.backend != "async":
+            parser.error("--processes needs the async backend")
+        if args.h3_resolution is not None and h3 is None:
+            parser.error("--h3-resolution needs the h3 package")
+    if args.mode == "capacity":
+        if args.backend != "async":
+            parser.error("capacity needs the async backend to stop steps early")
+        if args.max_hold < 4 * args.interval:
+            parser.error("--max-hold must cover a warm-up and three --interval windows")
+    if args.mode == "ab":
+        if "details" in args.profile:
+            parser.error("/details can't be A/B tested, its request ids are specific to one server")
+        schedule = synthetic_schedule(args.rate, args.duration, False, args.seed, args.profile, args.cities)
+        ab_result = asyncio.run(run_ab(args.server, args.server_b, schedule, args.connections, args.timeout, args.seed))
+        print_ab(ab_result, args.server, args.server_b, args.alpha)
+    elif args.mode == "sweep":
+        args.cells = sweep_cells(args.search_times, args.agency_counts, args.mode_sets, args.start_times)
+        print(f"Sweeping {len(args.cells)} parameter combinations, {len(args.cells) * args.per_cell} requests")
+        result = run_load(args)
+        print_report(result, args.rate)
+        write_sweep(result, args.cells, args.output)
+        if args.heatmap:
+            write_heatmap(result, args)
+        save_result(args, result)
+    elif args.mode == "capacity":
+        rows, best, failed = capacity_search(args)
+        knee = knee_point(rows)
+        write_capacity(rows, knee, args.slo_p99_ms, args.output)
+        if best is None:
+            print(f"Even {args.start_rate:g}/s breaks the SLO")
+        else:
+            top = max((row for row in rows if row["passed"]), key=lambda row: row["rate"])
+            print(f"Maximum sustainable rate: {top['rate']:g}/s ({top['throughput']:.1f}/s answered, p99 "
+                  f"{top['p99_ms']:.1f}ms against {args.slo_p99_ms:g}ms)"
+                  + ("" if failed is not None else f", every step passed up to --max-rate {args.max_rate:g}"))
+        if knee is not None:
+            print(f"Knee: {knee['rate']:g}/s, p99 {knee['p99_ms']:.1f}ms")
+        if best is not None:
+            args.rate = top["rate"]
+            if args.heatmap:
+                write_heatmap(best, args)
+            save_result(args, best)
+    elif args.mode in ("open", "replay"):
+        result = run_load(args)
+        print_report(result, getattr(args, "rate", None))
+        if args.heatmap:
+            write_heatmap(result, args)
+        save_result(args, result)
+    else:
+        run_profiling(args.server, getattr(args, "count", 10000))
@@ -0,0 +1,87 @@
+import argparse
+import gzip
+import hashlib
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from tile_inventory import INDEX_NAME, TileInventory, walk_cache
+
+# Offline pass that recompresses cached tiles at the highest ratio available. web.rs sends the files as-is with
+# `Content-Encoding: gzip`, so every byte saved here is saved on every tile request at no runtime cost.
+
+try:
+    import zopfli.gzip
+except ImportError:
+    zopfli = None
+
+
+def compress_max(data: bytes, iterations: int) -> bytes:
+    if zopfli is not None:
+        return zopfli.gzip.compress(data, numiterations=iterations)
+    # Level 9 with the largest window and memory level; mtime is left at zero for reproducible output
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31, 9)
+    return compressor.compress(data) + compressor.flush()
+
+
+def recompress_tile(task: tuple) -> tuple:
+    path, iterations, dry_run = task
+    with open(path, "rb") as f:
+        original = f.read()
+    try:
+        data = gzip.decompress(original)
+    except (OSError, EOFError, zlib.error):
+        return path, len(original), len(original), None, "invalid"
+
+    compressed = compress_max(data, iterations)
+    if len(compressed) >= len(original):
+        return path, len(original), len(original), None, "kept"
+    if not dry_run:
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(compressed)
+        os.replace(f"{path}.tmp", path)
+    return path, len(original), len(compressed), hashlib.sha1(compressed).hexdigest(), "replaced"
+
+
+def recompress(cache_dir: str, workers: int, iterations: int, dry_run: bool):
+    inventory = TileInventory(cache_dir).load() if os.path.exists(os.path.join(cache_dir, INDEX_NAME)) else None
+    tiles = {path: (zoom, x, y) for zoom, x, y, path, _ in walk_cache(cache_dir)}
+    print(f"Recompressing {len(tiles)} tiles in {cache_dir} with {'zopfli' if zopfli else 'zlib level 9'}")
+
+    t = time.time()
+    counts = {"replaced": 0, "kept": 0, "invalid": 0}
+    before = after = 0
+    tasks = ((path, iterations, dry_run) for path in tiles)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for i, (path, old_size, new_size, sha1, status) in enumerate(
+                executor.map(recompress_tile, tasks, chunksize=64), start=1):
+            counts[status] += 1
+            before += old_size
+            after += new_size
+            if status == "invalid":
+                print(f"Not a valid gzip tile: {path}")
+            elif status == "replaced" and inventory is not None and not dry_run:
+                inventory.add(tiles[path], new_size, sha1)
+            if i % 10000 == 0:
+                print(f"{i} / {len(tiles)} tiles, {(before - after) / 1e6:.1f} MB saved so far")
+
+    if inventory is not None:
+        inventory.close()
+    saved = before - after
+    print(f"Done in {time.time() - t:.1f}s: {counts['replaced']} replaced, {counts['kept']} kept, "
+          f"{counts['invalid']} invalid. {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB, "
+          f"{saved / 1e6:.1f} MB saved ({100 * saved / max(before, 1):.1f}%)"
+          + (" (dry run)" if dry_run else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompress cached gzip tiles at the highest ratio, keeping a tile "
+                                                 "only when the new version is smaller")
+    parser.add_argument("--cache-dir", default="vancouver-cache/all_cities")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--iterations", type=int, default=15, help="Zopfli iterations, when zopfli is installed")
+    parser.add_argument("--dry-run", action="store_true", help="Report the savings without replacing any tile")
+    args = parser.parse_args()
+
+    recompress(args.cache_dir, args.workers, args.iterations, args.dry_run)
@@ -1,46 +1,265 @@
-import json
-import os.path
+import argparse
+import asyncio
+import gzip
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
+import aiohttp
 import flask
-import requests
+
+from http_retry import RETRYABLE_ERRORS, atomic_file, raise_for_overload, with_retries
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # NY Penn station latitude longitude
 # 40.750580, -73.993584
 BODY = {"latitude":40.750580,"longitude":-73.993584, "agencies":["MTA New York City Transit","MTA Bus Company","NJ TRANSIT BUS","NJ TRANSIT RAIL","Port Authority Trans-Hudson Corporation","Union City Transit","Capitol Corridor Joint Powers Authority","San Francisco International Airport","Altamont Corridor Express","Emery Go-Round","Petaluma","Mission Bay TMA","Santa Rosa CityBus","MVgo Mountain View","Angel Island Tiburon Ferry","SolTrans","County Connection","Dumbarton Express Consortium","San Francisco Municipal Transportation Agency","AC TRANSIT","Marin Transit","VINE Transit","Livermore Amador Valley Transit Authority","Sonoma County Transit","Sonoma Marin Area Rail Transit","Treasure Island Ferry","Tri Delta Transit","Golden Gate Ferry","Golden Gate Transit","City of South San Francisco","San Francisco Bay Ferry","Commute.org Shuttles","Caltrain","SamTrans","VTA","Bay Area Rapid Transit","TTC","UP Express","GO Transit","York Region Transit","Brampton Transit","MiWay","GRT","Société de transport de Montréal","TransLink","Chicago Transit Authority","RER","Noctilien","TER","Transilien","Terres d'Envol","Poissy - Les Mureaux","Phébus","Paris-Saclay Mobilités","Seine-Saint-Denis","Bus Haut Val d'Oise","Sit'bus","Grand Melun","Valoise","Chavilbus","Seine Essonne Bus","Aérial","Tam Limay","Saint Germain Boucles de Seine","Argenteuil - Boucles de Seine","Génovébus","SITUS","Vélizy Vallées","Arlequin","Saint-Quentin-en-Yvelines","Plaine de Versailles","Meaux et Ourcq","Goëlys","ValBus","Paris Saclay","Traverciel","Apolo 7","Val de Seine","Orgebus","Brie et 2 Morin","Vallée Grand Sud Paris","Sénart","Marne et Seine","Vexin","Vallée de Montmorency","Bièvre","Val d'Yerres Val de Seine","Comète","Bassin de Claye","Essonne Sud Est","Roissy Ouest","Siyonne","Conflans Achères","Seine et Marne Express","Filéo","Essonne Sud Ouest","Réseau du Canton de Perthes","Busval d'Oise","STILL","Titus","Pays Briard","Houdanais","Rambouillet Urbain","Parisis","Mantois","Marne-la-Vallée","STILE Express","Rambouillet Interurbain","Scolaire Est Yvelines","Seine Grand Orly","RATP","Transdev CEAT","Keolis Meyer","CIF","Trans Val d'Oise","Aéroport Paris-Beauvais / SAGEB","Cars Lacroix","Cars Moreau","Transdev Ile-de-France Lys","Cars Rose","SAVAC","Transdev Ile-de-France Vulaines","Stivo","Magical Shuttle","TICE","ADP","ProCars","Transdev Autocars Tourneux","Autobus du Fort","Cars Soeur","Transdev Valmy","Darche Gros","Keolis Mobilité Roissy","Transdev Ile-de-France Conflans","Francilité Grand Provinois","Albatrans","Keolis Ouest Val-de-Marne","Cars Hourtoule","STAVO","Transdev CSO","Les Cars Bleus","SETRA","Cars Losay","Mobicité","Autocars Dominique","Keolis Val d'Oise"],"modes":["bus","subway","tram","rail","ferry"],"startTime":18060,"maxSearchTime":2700}
 START_TIME = 5 * 3600
+END_TIME = 27 * 3600
+HELLO_URL = "https://api-map-v2.henryn.ca/hello/"
+
+FRAME_RE = re.compile(r"responsenyc(\d+)\.txt$")
+# Precompressed copies are kept next to each frame as responsenyc<time>.txt.gz / .br
+SUFFIXES = {"gzip": ".gz", "br": ".br"}
+
+
+def frame_path(frames_dir: str, start_time: int) -> str:
+    return os.path.join(frames_dir, f"responsenyc{start_time}.txt")
+
+
+def write_atomic(path: str, data: bytes):
+    with atomic_file(path) as f:
+        f.write(data)
+
+
+def load_frame(task: tuple) -> tuple:
+    # Compresses a frame, or reads its compressed copies when they are newer than it. The ETag comes from the
+    # frame's mtime and size, like nginx's, so a fresh frame is never read whole.
+    path, brotli_quality = task
+    stat = os.stat(path)
+    frame = {"path": path, "mtime": stat.st_mtime_ns, "etag": f"{stat.st_mtime_ns:x}-{stat.st_size:x}"}
+    data = None
+    for encoding, suffix in SUFFIXES.items():
+        if encoding == "br" and brotli is None:
+            continue
+        compressed_path = path + suffix
+        if os.path.exists(compressed_path) and os.stat(compressed_path).st_mtime_ns >= stat.st_mtime_ns:
+            with open(compressed_path, "rb") as f:
+                frame[encoding] = f.read()
+            continue
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        if encoding == "br":
+            frame[encoding] = brotli.compress(data, mode=brotli.MODE_TEXT, quality=brotli_quality)
+        else:
+            frame[encoding] = gzip.compress(data, 9, mtime=0)
+        write_atomic(compressed_path, frame[encoding])
+    return path, frame
+
+
+class FrameStore:
+    # Frames by start time with their compressed bodies in memory; uncompressed responses are sent from disk
+
+    def __init__(self, frames_dir: str, brotli_quality: int = 9):
+        self.frames_dir = frames_dir
+        self.brotli_quality = brotli_quality
+        self.frames = {}
+        self.lock = threading.Lock()
+        self.frame_locks = defaultdict(threading.Lock)
+
+    def index(self, workers: int):
+        paths = {}
+        for name in os.listdir(self.frames_dir):
+            match = FRAME_RE.fullmatch(name)
+            if match:
+                paths[os.path.join(self.frames_dir, name)] = int(match.group(1))
+        print(f"Indexing {len(paths)} frames in {self.frames_dir}")
+        t = time.time()
+        tasks = ((path, self.brotli_quality) for path in paths)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for path, frame in executor.map(load_frame, tasks):
+                self.frames[paths[path]] = frame
+        sizes = {encoding: sum(len(frame[encoding]) for frame in self.frames.values() if encoding in frame)
+                 for encoding in SUFFIXES}
+        print(f"Indexed in {time.time() - t:.1f}s, " + ", ".join(f"{size / 1e6:.1f} MB {encoding}"
+                                                               for encoding, size in sizes.items() if size))
+
+    def get(self, start_time: int) -> dict | None:
+        # Frames captured or rewritten after startup are picked up here
+        path = frame_path(self.frames_dir, start_time)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        frame = self.frames.get(start_time)
+        if frame is not None and frame["mtime"] == mtime:
+            return frame
+        # One request reloads a changed frame; the others wait for it instead of compressing it again
+        with self.lock:
+            frame_lock = self.frame_locks[start_time]
+        with frame_lock:
+            frame = self.frames.get(start_time)
+            if frame is None or frame["mtime"] != mtime:
+                try:
+                    _, frame = load_frame((path, self.brotli_quality))
+                except FileNotFoundError:
+                    return None
+                self.frames[start_time] = frame
+        return frame
+
 
 # Flask simple file loader
 app = flask.Flask(__name__)
 
-@app.route("/<starttime>")
+
+def choose_encoding(frame: dict) -> str | None:
+    # The client's most preferred encoding we have, brotli on a tie
+    accepted = flask.request.accept_encodings
+    candidates = [encoding for encoding in ("br", "gzip") if encoding in frame and accepted.quality(encoding) > 0]
+    return max(candidates, key=accepted.quality, default=None)
+
+
+@app.route("/<int:starttime>")
 def index(starttime: int):
+    frame = app.config["FRAME_STORE"].get(starttime)
+    if frame is None:
+        flask.abort(404)
+    encoding = choose_encoding(frame)
+    etag = f"{frame['etag']}-{encoding}" if encoding else frame["etag"]
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    elif encoding:
+        response = flask.Response(frame[encoding], mimetype="application/json")
+        response.headers["Content-Encoding"] = encoding
+    else:
+        response = flask.send_file(frame["path"], mimetype="application/json", etag=False, conditional=False)
+    response.set_etag(etag)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = f"public, max-age={app.config['MAX_AGE']}"
     # Set cors headers
-    response = flask.Response(
-        open(f"/tmp/responsenyc{starttime}.txt", "r").read(),
-        mimetype="application/json",
-    )
     response.headers["Access-Control-Allow-Origin"] = "*"
     return response
 
-app.run(host="127.0.0.1", port = 8000)
 
-if __name__ == "__main__":
-    while START_TIME < 27 * 3600:
-        print("starting ", START_TIME)
-        if os.path.exists(f"/tmp/responsenyc{START_TIME}.txt"):
-            START_TIME += 60
-            continue
+class FrameCaptureError(Exception):
+    pass
+
+
+async def write_frame(response: aiohttp.ClientResponse, path: str) -> int:
+    size = 0
+    with atomic_file(path) as f:
+        async for chunk in response.content.iter_chunked(1 << 16):
+            f.write(chunk)
+            size += len(chunk)
+    return size
 
 
-        BODY["startTime"] = START_TIME
+async def capture_frame(session: aiohttp.ClientSession, url: str, path: str, start_time: int, retries: int,
+                        backoff: float) -> tuple:
+    # Returns (bytes written, attempts). 429s, 5xxs, timeouts and connection errors are retried; other statuses
+    # fail the frame at once.
+    body = dict(BODY, startTime=start_time)
 
-        # Convert the above to python requests
-        response = requests.post(
-            "https://api-map-v2.henryn.ca/hello/",
-            json=BODY,
-        )
+    async def attempt_capture(attempt: int) -> tuple:
+        async with session.post(url, json=body) as response:
+            raise_for_overload(response)
+            if response.status != 200:
+                raise FrameCaptureError(f"{start_time}: HTTP {response.status}")
+            return await write_frame(response, path), attempt
 
-        open(f"/tmp/responsenyc{START_TIME}.txt", "w").write(response.text)
+    try:
+        return await with_retries(attempt_capture, retries, backoff)
+    except RETRYABLE_ERRORS as e:
+        raise FrameCaptureError(f"{start_time}: {e!r} after {retries + 1} attempts") from e
 
-        START_TIME += 60
 
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes // 60}:{minutes % 60:02d}:{seconds:02d}"
+
+
+async def capture(args) -> list:
+    # Frames already on disk are skipped, so an interrupted capture resumes where it stopped. At most
+    # --concurrency requests are in flight; returns the start times that failed.
+    start_times = range(args.start, args.end, args.step)
+    missing = [start_time for start_time in start_times
+               if not os.path.exists(frame_path(args.frames_dir, start_time))]
+    print(f"Capturing {len(missing)} frames, {len(start_times) - len(missing)} already captured")
+    slots = asyncio.Semaphore(args.concurrency)
+    completed = 0
+    written = 0
+    failed = []
+    t = time.monotonic()
+
+    async def run_one(session: aiohttp.ClientSession, start_time: int):
+        nonlocal completed, written
+        async with slots:
+            try:
+                size, attempts = await capture_frame(session, args.url, frame_path(args.frames_dir, start_time),
+                                                     start_time, args.retries, args.backoff)
+            except FrameCaptureError as e:
+                failed.append(start_time)
+                print("Failed! ", e)
+                return
+        completed += 1
+        written += size
+        elapsed = time.monotonic() - t
+        remaining = len(missing) - completed - len(failed)
+        print(f"{start_time}: {size / 1e6:.1f} MB" + (f" after {attempts} attempts" if attempts > 1 else "")
+              + f". {completed} / {len(missing)} frames, {completed / elapsed:.2f} frames/s, "
+              f"ETA {format_duration(remaining * elapsed / completed)}")
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=args.timeout)) as session:
+        await asyncio.gather(*(run_one(session, start_time) for start_time in missing))
+    print(f"Captured {completed} frames, {written / 1e6:.1f} MB in {format_duration(time.monotonic() - t)}, "
+          f"{len(failed)} failed")
+    return sorted(failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capture /hello responses for every minute of the day and serve "
+                                                 "them as animation frames")
+    parser.add_argument("--frames-dir", default="/tmp")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve = subparsers.add_parser("serve", help="Serve captured frames at /<start time>")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes compressing frames at startup")
+    serve.add_argument("--brotli-quality", type=int, default=9)
+    serve.add_argument("--max-age", type=int, default=3600, help="Seconds browsers may reuse a frame without "
+                                                                 "revalidating it")
+    capture_parser = subparsers.add_parser("capture", help="Request the frames that are missing")
+    capture_parser.add_argument("--url", default=HELLO_URL)
+    capture_parser.add_argument("--start", type=int, default=START_TIME, help="First startTime, seconds after midnight")
+    capture_parser.add_argument("--end", type=int, default=END_TIME, help="startTime to stop before")
+    capture_parser.add_argument("--step", type=int, default=60, help="Seconds between frames")
+    capture_parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight")
+    capture_parser.add_argument("--retries", type=int, default=4)
+    capture_parser.add_argument("--backoff", type=float, default=2.0, help="Initial retry backoff in seconds")
+    capture_parser.add_argument("--timeout", type=float, default=600.0, help="Per-request timeout in seconds")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        if brotli is None:
+            print("brotli is not installed, serving gzip only")
+        store = FrameStore(args.frames_dir, args.brotli_quality)
+        store.index(args.workers)
+        app.config["FRAME_STORE"] = store
+        app.config["MAX_AGE"] = args.max_age
+        app.run(host=args.host, port=args.port)
+    else:
+        failed = asyncio.run(capture(args))
+        if failed:
+            print("Failed frames, rerun to retry them:", ", ".join(map(str, failed)))
+            sys.exit(1)
@@ -0,0 +1,48 @@
+import random
+from collections import Counter
+
+import pytest
+
+from profiling import MAX_SEARCH_TIME, arrival_times, build_parser, sweep_cells, with_shared_seed, worker_schedule
+
+# argparse runs string defaults through their type, so a bad default only shows up when the mode is run
+
+
+@pytest.mark.parametrize("argv", [
+    ["closed"],
+    ["open", "--rate", "10"],
+    ["replay", "capture.jsonl"],
+    ["ab", "--server-b", "http://localhost:8080"],
+    ["sweep"],
+    ["capacity", "--slo-p99-ms", "500"],
+])
+def test_default_arguments_parse(argv):
+    build_parser().parse_args(argv)
+
+
+def test_sweep_default_search_times_are_allowed():
+    args = build_parser().parse_args(["sweep"])
+    assert max(args.search_times) < MAX_SEARCH_TIME
+
+
+@pytest.mark.parametrize("rate, duration, expected", [(100, 5, 500), (10, 30, 300), (3, 0.1, 1), (2.5, 1, 3)])
+def test_even_arrivals_send_rate_times_duration(rate, duration, expected):
+    offsets = list(arrival_times(rate, duration, False, random.Random(0)))
+    assert len(offsets) == expected
+    assert all(offset < duration for offset in offsets)
+
+
+def test_multi_process_sweep_sends_per_cell_requests_per_cell():
+    args = build_parser().parse_args(["sweep", "--per-cell", "10", "--processes", "2"])
+    args.cells = sweep_cells(args.search_times, args.agency_counts, args.mode_sets, args.start_times)
+    args = with_shared_seed(args)
+    counts = Counter(tag for index in range(args.processes) for _, request in worker_schedule(args, index)
+                     for tag in request.tags if tag.startswith("sweep="))
+    assert len(counts) == len(args.cells)
+    assert set(counts.values()) == {10}
+
+
+@pytest.mark.parametrize("speed", ["0", "-2", "nan"])
+def test_replay_rejects_non_positive_speed(speed):
+    with pytest.raises(SystemExit):
+        build_parser().parse_args(["replay", "capture.jsonl", "--speed", speed])
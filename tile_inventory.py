@@ -0,0 +1,199 @@
+import argparse
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+from collections import defaultdict
+
+# SQLite index of the tiles present in a cache directory laid out as {z}/{x}/{y}.pbf, so membership checks
+# don't need a stat per tile. Rebuild it with `python tile_inventory.py scan` if the tree is changed by hand.
+
+INDEX_NAME = "inventory.sqlite"
+
+
+def file_sha1(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def walk_cache(cache_dir: str):
+    # One scandir per directory; yields (zoom, x, y, path, size)
+    for z_entry in os.scandir(cache_dir):
+        if not z_entry.is_dir() or not z_entry.name.isdigit():
+            continue
+        for x_entry in os.scandir(z_entry.path):
+            if not x_entry.is_dir() or not x_entry.name.isdigit():
+                continue
+            for y_entry in os.scandir(x_entry.path):
+                name = y_entry.name
+                if not name.endswith(".pbf") or not name[:-4].isdigit():
+                    continue
+                yield int(z_entry.name), int(x_entry.name), int(name[:-4]), y_entry.path, y_entry.stat().st_size
+
+
+class TileInventory:
+    def __init__(self, cache_dir: str, index_path: str | None = None):
+        self.cache_dir = cache_dir
+        self.index_path = index_path or os.path.join(cache_dir, INDEX_NAME)
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        self.exists = os.path.exists(self.index_path)
+
+        self.db = sqlite3.connect(self.index_path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS tiles (
+            zoom INTEGER, x INTEGER, y INTEGER, size INTEGER, sha1 TEXT,
+            PRIMARY KEY (zoom, x, y)
+        ) WITHOUT ROWID""")
+        # Tiles known to have empty or near-empty bodies; the prefill skips their descendants
+        self.db.execute("""CREATE TABLE IF NOT EXISTS empty_tiles (
+            zoom INTEGER, x INTEGER, y INTEGER,
+            PRIMARY KEY (zoom, x, y)
+        ) WITHOUT ROWID""")
+        self.tiles = {}
+        self.empty = set()
+        self.pending = 0
+
+    def scan(self, hashes: bool = False):
+        t = time.time()
+        self.db.execute("DELETE FROM tiles")
+        batch = []
+        for zoom, x, y, path, size in walk_cache(self.cache_dir):
+            batch.append((zoom, x, y, size, file_sha1(path) if hashes else None))
+            if len(batch) >= 10000:
+                self.db.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?, ?)", batch)
+                batch = []
+        self.db.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?, ?)", batch)
+        self.db.commit()
+        self.exists = True
+        self.load()
+        print(f"Indexed {len(self.tiles)} tiles in {self.cache_dir} in {time.time() - t:.1f}s")
+
+    def load(self):
+        self.tiles = {(zoom, x, y): size for zoom, x, y, size in self.db.execute("SELECT zoom, x, y, size FROM tiles")}
+        self.empty = set(self.db.execute("SELECT zoom, x, y FROM empty_tiles"))
+        return self
+
+    def __contains__(self, tile: tuple) -> bool:
+        return tile in self.tiles
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def add(self, tile: tuple, size: int, sha1: str | None = None):
+        self.tiles[tile] = size
+        self.db.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)", (*tile, size, sha1))
+        self.written()
+
+    def remove(self, tile: tuple):
+        self.tiles.pop(tile, None)
+        self.db.execute("DELETE FROM tiles WHERE zoom = ? AND x = ? AND y = ?", tile)
+        self.written()
+
+    def is_empty(self, tile: tuple, empty_bytes: int) -> bool:
+        if tile in self.empty:
+            return True
+        size = self.tiles.get(tile)
+        if size is not None and size <= empty_bytes:
+            self.mark_empty(tile)
+            return True
+        return False
+
+    def mark_empty(self, tile: tuple):
+        self.empty.add(tile)
+        self.db.execute("INSERT OR IGNORE INTO empty_tiles VALUES (?, ?, ?)", tile)
+        self.written()
+
+    def unmark_empty(self, tile: tuple):
+        self.empty.discard(tile)
+        self.db.execute("DELETE FROM empty_tiles WHERE zoom = ? AND x = ? AND y = ?", tile)
+        self.written()
+
+    def written(self):
+        # Commits every 500 changes, so a long prune or invalidation is never one huge transaction
+        self.pending += 1
+        if self.pending >= 500:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def coverage(self, candidates=None) -> dict:
+        # Per-zoom counts and bytes of present tiles; with candidates, only those tiles are counted
+        stats = defaultdict(lambda: {"present": 0, "bytes": 0})
+        if candidates is None:
+            for (zoom, _, _), size in self.tiles.items():
+                stats[zoom]["present"] += 1
+                stats[zoom]["bytes"] += size
+            for zoom, _, _ in self.empty:
+                stats[zoom]["empty"] = stats[zoom].get("empty", 0) + 1
+        else:
+            for tile in candidates:
+                zoom_stats = stats[tile[0]]
+                zoom_stats["candidates"] = zoom_stats.get("candidates", 0) + 1
+                size = self.tiles.get(tile)
+                if size is not None:
+                    zoom_stats["present"] += 1
+                    zoom_stats["bytes"] += size
+        return dict(sorted(stats.items()))
+
+
+def merge(destination: TileInventory, source_dirs: list):
+    # Copies tiles that are missing from the destination out of other shards' cache directories and merges their
+    # empty tile knowledge
+    for source_dir in source_dirs:
+        source = TileInventory(source_dir)
+        if not source.exists:
+            source.scan()
+        copied = 0
+        for zoom, x, y, size, sha1 in source.db.execute("SELECT zoom, x, y, size, sha1 FROM tiles").fetchall():
+            if (zoom, x, y) in destination:
+                continue
+            relative = os.path.join(str(zoom), str(x), f"{y}.pbf")
+            target = os.path.join(destination.cache_dir, relative)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(os.path.join(source_dir, relative), f"{target}.tmp")
+            os.replace(f"{target}.tmp", target)
+            destination.add((zoom, x, y), size, sha1)
+            copied += 1
+        for tile in source.db.execute("SELECT zoom, x, y FROM empty_tiles").fetchall():
+            destination.mark_empty(tile)
+        source.close()
+        destination.commit()
+        print(f"Merged {copied} tiles from {source_dir}")
+
+
+def print_coverage(stats: dict):
+    for zoom, zoom_stats in stats.items():
+        line = f"z{zoom}: {zoom_stats['present']} tiles, {zoom_stats['bytes'] / 1e6:.1f} MB"
+        if "empty" in zoom_stats:
+            line += f", {zoom_stats['empty']} empty"
+        if "candidates" in zoom_stats:
+            line += (f", {zoom_stats['present']} / {zoom_stats['candidates']} candidates "
+                     f"({100 * zoom_stats['present'] / zoom_stats['candidates']:.1f}%)")
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the tiles present in a tile cache directory")
+    parser.add_argument("command", choices=["scan", "stats", "merge"])
+    parser.add_argument("--cache-dir", default="vancouver-cache/all_cities")
+    parser.add_argument("--index", default=None, help=f"Index path, defaults to {{cache-dir}}/{INDEX_NAME}")
+    parser.add_argument("--hashes", action="store_true", help="Also record the sha1 of every tile while scanning")
+    parser.add_argument("--from", dest="sources", action="append", default=[],
+                        help="Cache directory of another prefill shard to merge in. Repeatable")
+    args = parser.parse_args()
+
+    inventory = TileInventory(args.cache_dir, args.index)
+    if args.command == "scan":
+        inventory.scan(args.hashes)
+    else:
+        inventory.load()
+    if args.command == "merge":
+        merge(inventory, args.sources)
+    print_coverage(inventory.coverage())
+    inventory.close()
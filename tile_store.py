@@ -0,0 +1,147 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+
+from tile_inventory import walk_cache
+
+# Content-addressed tile store: every distinct tile body is kept once in `images`, keyed by its sha1, and `map`
+# points each z/x/y at a body. The layout is the deduplicated MBTiles schema, so the `tiles` view can be read by
+# MBTiles tooling. import-dir/export-dir convert to and from the {z}/{x}/{y}.pbf cache directory layout.
+
+
+class TileStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+            CREATE TABLE IF NOT EXISTS map (
+                zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT,
+                PRIMARY KEY (zoom_level, tile_column, tile_row)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS map_tile_id ON map (tile_id);
+            CREATE VIEW IF NOT EXISTS tiles AS
+                SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row,
+                       images.tile_data AS tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id;
+        """)
+        self.db.execute("INSERT OR IGNORE INTO metadata VALUES ('format', 'pbf')")
+        self.db.commit()
+
+    @staticmethod
+    def tms_row(zoom: int, y: int) -> int:
+        # MBTiles rows count from the bottom; flipping is its own inverse
+        return (2 ** zoom) - 1 - y
+
+    def put(self, zoom: int, x: int, y: int, data: bytes) -> str:
+        tile_id = hashlib.sha1(data).hexdigest()
+        self.db.execute("INSERT OR IGNORE INTO images VALUES (?, ?)", (tile_id, data))
+        self.db.execute("INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)", (zoom, x, self.tms_row(zoom, y), tile_id))
+        return tile_id
+
+    def get(self, zoom: int, x: int, y: int) -> bytes | None:
+        row = self.db.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (zoom, x, self.tms_row(zoom, y)),
+        ).fetchone()
+        return row[0] if row else None
+
+    def delete(self, zoom: int, x: int, y: int):
+        self.db.execute("DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                        (zoom, x, self.tms_row(zoom, y)))
+
+    def vacuum(self) -> int:
+        # Drop bodies no longer referenced by any tile
+        removed = self.db.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)").rowcount
+        self.db.commit()
+        self.db.execute("VACUUM")
+        return removed
+
+    def entries(self):
+        # Yields (zoom, x, y, tile_id) in XYZ numbering
+        for zoom, x, row, tile_id in self.db.execute("SELECT zoom_level, tile_column, tile_row, tile_id FROM map"):
+            yield zoom, x, self.tms_row(zoom, row), tile_id
+
+    def image(self, tile_id: str) -> bytes:
+        return self.db.execute("SELECT tile_data FROM images WHERE tile_id = ?", (tile_id,)).fetchone()[0]
+
+    def stats(self) -> dict:
+        tiles = self.db.execute("SELECT count(*) FROM map").fetchone()[0]
+        unique, unique_bytes = self.db.execute("SELECT count(*), coalesce(sum(length(tile_data)), 0) FROM images").fetchone()
+        logical_bytes = self.db.execute(
+            "SELECT coalesce(sum(length(images.tile_data)), 0) FROM map JOIN images ON images.tile_id = map.tile_id"
+        ).fetchone()[0]
+        return {"tiles": tiles, "unique": unique, "unique_bytes": unique_bytes, "logical_bytes": logical_bytes}
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def import_dir(store: TileStore, cache_dir: str):
+    t = time.time()
+    count = 0
+    for zoom, x, y, path, _ in walk_cache(cache_dir):
+        with open(path, "rb") as f:
+            store.put(zoom, x, y, f.read())
+        count += 1
+        if count % 10000 == 0:
+            store.commit()
+            print(f"Imported {count} tiles")
+    store.commit()
+    print(f"Imported {count} tiles from {cache_dir} in {time.time() - t:.1f}s")
+
+
+def export_dir(store: TileStore, cache_dir: str, hardlink: bool = False):
+    # With hardlink, every copy of a body after the first is a link to the first file, so duplicates cost a
+    # directory entry instead of an inode and data blocks.
+    t = time.time()
+    first_paths = {}
+    count = 0
+    for zoom, x, y, tile_id in store.entries():
+        path = os.path.join(cache_dir, str(zoom), str(x), f"{y}.pbf")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+
+        if hardlink and tile_id in first_paths:
+            os.link(first_paths[tile_id], path)
+        else:
+            with open(path, "wb") as f:
+                f.write(store.image(tile_id))
+            if hardlink:
+                first_paths[tile_id] = path
+        count += 1
+    print(f"Exported {count} tiles to {cache_dir} in {time.time() - t:.1f}s")
+
+
+def print_stats(stats: dict):
+    saved = stats["logical_bytes"] - stats["unique_bytes"]
+    print(f"{stats['tiles']} tiles, {stats['unique']} unique bodies, "
+          f"{stats['unique_bytes'] / 1e6:.1f} MB stored for {stats['logical_bytes'] / 1e6:.1f} MB of tiles "
+          f"({saved / 1e6:.1f} MB saved by deduplication)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Content-deduplicated vector tile store")
+    parser.add_argument("command", choices=["import-dir", "export-dir", "stats", "vacuum"])
+    parser.add_argument("--store", default="all_cities.mbtiles")
+    parser.add_argument("--cache-dir", default="vancouver-cache/all_cities")
+    parser.add_argument("--hardlink", action="store_true", help="Hard-link duplicate tiles when exporting")
+    args = parser.parse_args()
+
+    store = TileStore(args.store)
+    if args.command == "import-dir":
+        import_dir(store, args.cache_dir)
+    elif args.command == "export-dir":
+        export_dir(store, args.cache_dir, args.hardlink)
+    elif args.command == "vacuum":
+        print(f"Removed {store.vacuum()} unreferenced bodies")
+    print_stats(store.stats())
+    store.close()